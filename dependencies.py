@@ -1,24 +1,35 @@
 import os
 import json
+import time
 import base64
-import requests
-from datetime import datetime
+import asyncio
+import mage_client.client as mage_client
+from redis.exceptions import RedisError
+from redis_cache.cache import redis_client
 
+# If .env exists locally, use that for environment variables
+# In a docker image is built ignoring the .env so it can't appear in a container
+if os.path.exists(".env"):
+    from dotenv import load_dotenv
 
-class Token:
-    def __init__(self) -> None:
-        # If .env exists locally, use that for environment variables
-        # In a docker image is built ignoring the .env so it can't appear in a container
-        if os.path.exists(".env"):
-            from dotenv import load_dotenv
+    load_dotenv(".env")
 
-            load_dotenv(".env")
+TOKEN_KEY = "mage:token"
+TOKEN_LOCK_KEY = "mage:token:lock"
 
-        if os.getenv("AUTH") == "false":
-            self.token = "token"
-            self.expires = 0.0
-            return
 
+class Token:
+    def __init__(self) -> None:
+        self.token = ""
+        self.expires = 0.0
+        # Refresh the token this many seconds before it expires
+        self.refresh_margin = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+        # Share the token between the workers through Redis so only one of them logs in
+        self.shared = os.getenv("TOKEN_SHARED", "false") == "true"
+        self._lock = asyncio.Lock()
+        self._refresher: asyncio.Task | None = None
+
+    async def _login(self) -> tuple[str, float]:
         url = os.getenv("BASE_URL") + "/api/sessions"
         headers = {
             "Content-Type": "application/json",
@@ -31,7 +42,7 @@ class Token:
             }
         }
 
-        response = requests.post(url, data=json.dumps(data), headers=headers)
+        response = await mage_client.request("POST", url, content=json.dumps(data), headers=headers)
 
         token = ""
         expires = 0.0
@@ -41,43 +52,131 @@ class Token:
             token = decode_token["token"]
             expires = float(decode_token["expires"])
 
-        self.token = token
-        self.expires = expires
+        return token, expires
 
-    def update_token(self) -> None:
-        url = os.getenv("BASE_URL") + "/api/sessions"
-        headers = {
-            "Content-Type": "application/json",
-            "X-API-KEY": os.getenv("API_KEY")
-        }
-        data = {
-            "session": {
-                "email": os.getenv("EMAIL").strip().replace("\n", ""),
-                "password": os.getenv("PASSWORD").strip().replace("\n", "")
-            }
-        }
+    def _expired(self, expires: float) -> bool:
+        return time.time() >= expires - self.refresh_margin
 
-        response = requests.post(url, data=json.dumps(data), headers=headers)
-        token = ""
-        expires = 0.0
-        if response.status_code == 200:
-            body = json.loads(response.content.decode('utf-8'))
-            decode_token = json.loads(base64.b64decode(body['session']['token'].split('.')[1].encode('utf-8') + b'=='))
-            token = decode_token["token"]
-            expires = float(decode_token["expires"])
-        
-        self.token = token
-        self.expires = expires
+    def _read_shared(self) -> tuple[str, float] | None:
+        try:
+            value = redis_client.get(TOKEN_KEY)
+        except RedisError:
+            return None
+
+        if value is None:
+            return None
+
+        shared = json.loads(value.decode())
+        if self._expired(shared["expires"]):
+            return None
+
+        return shared["token"], shared["expires"]
+
+    def _write_shared(self, token: str, expires: float) -> None:
+        ttl = int(expires - time.time())
+        if token == "" or ttl <= 0:
+            return
+
+        try:
+            redis_client.setex(TOKEN_KEY, ttl, json.dumps({"token": token, "expires": expires}))
+        except RedisError:
+            return
+
+    def _acquire_shared_lock(self) -> bool:
+        try:
+            return bool(redis_client.set(TOKEN_LOCK_KEY, os.getpid(), nx=True, ex=30))
+        except RedisError:
+            # Redis is not reachable, so every worker has to log in on its own
+            return True
+
+    def _release_shared_lock(self) -> None:
+        try:
+            redis_client.delete(TOKEN_LOCK_KEY)
+        except RedisError:
+            return
+
+    async def _shared_login(self) -> tuple[str, float]:
+        shared = self._read_shared()
+        if shared is not None:
+            return shared
+
+        if self._acquire_shared_lock():
+            try:
+                token, expires = await self._login()
+                self._write_shared(token, expires)
+                return token, expires
+            finally:
+                self._release_shared_lock()
+
+        # Another worker is logging in, wait for it to publish the new token
+        for _ in range(50):
+            await asyncio.sleep(0.2)
+            shared = self._read_shared()
+            if shared is not None:
+                return shared
+
+        return await self._login()
+
+    async def update_token(self, force: bool = False) -> None:
+        if os.getenv("AUTH") == "false":
+            self.token = "token"
+            self.expires = 0.0
+            return
+
+        # Only the first caller logs in, the others wait on the lock and reuse its result
+        async with self._lock:
+            if not force and not self.check_token_expired():
+                return
+
+            if self.shared and not force:
+                token, expires = await self._shared_login()
+            else:
+                token, expires = await self._login()
+                if self.shared:
+                    self._write_shared(token, expires)
+
+            self.token = token
+            self.expires = expires
 
     def check_token_expired(self) -> bool:
         if os.getenv("AUTH") == "false":
             return False
 
-        provided_time = datetime.fromtimestamp(self.expires)
+        return self._expired(self.expires)
 
-        current_time = datetime.now()
+    async def get_token(self) -> str:
+        if self.token == "" or self.check_token_expired():
+            await self.update_token()
+
+        return self.token
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            delay = self.expires - self.refresh_margin - time.time()
+            await asyncio.sleep(max(delay, 5.0))
+
+            try:
+                await self.update_token()
+            except Exception as e:
+                print(f"Failed to refresh the Mage token: {e}")
+
+    def start_refresher(self) -> None:
+        if os.getenv("AUTH") == "false" or self._refresher is not None:
+            return
+
+        self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def stop_refresher(self) -> None:
+        if self._refresher is None:
+            return
+
+        self._refresher.cancel()
+        try:
+            await self._refresher
+        except asyncio.CancelledError:
+            pass
+
+        self._refresher = None
 
-        if current_time < provided_time:
-            return False
 
-        return True
+token = Token()
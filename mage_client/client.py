@@ -0,0 +1,50 @@
+import os
+import httpx
+
+# A single AsyncClient per process keeps the TCP/TLS connections to BASE_URL alive between requests
+# instead of opening a new one for every call to Mage.
+_client: httpx.AsyncClient | None = None
+
+
+def _http2_enabled() -> bool:
+    if os.getenv("MAGE_HTTP2", "false") != "true":
+        return False
+
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("MAGE_HTTP2 is true but the h2 package is not installed, falling back to HTTP/1.1.")
+        return False
+
+    return True
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+
+    if _client is None or _client.is_closed:
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("MAGE_POOL_SIZE", "100")),
+            max_keepalive_connections=int(os.getenv("MAGE_POOL_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("MAGE_POOL_KEEPALIVE_EXPIRY", "30"))
+        )
+        timeout = httpx.Timeout(
+            float(os.getenv("MAGE_TIMEOUT", "60")),
+            connect=float(os.getenv("MAGE_CONNECT_TIMEOUT", "10"))
+        )
+        _client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=_http2_enabled())
+
+    return _client
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    return await get_client().request(method, url, **kwargs)
+
+
+async def close_client() -> None:
+    global _client
+
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+
+    _client = None
@@ -0,0 +1,89 @@
+import os
+import asyncio
+import mage_client.client as mage_client
+from redis_cache.cache import local_cache, delete_entries
+
+FILE_TREE_KEY = "files_tree"
+
+FILE_TREE_TTL = float(os.getenv("FILE_TREE_TTL", "30"))
+
+# Only one request per worker downloads the tree, the others wait and reuse it
+_lock = asyncio.Lock()
+
+
+class FileTree:
+    def __init__(self, root: dict) -> None:
+        """
+        Index over the Mage file tree returned by /api/files, built once per download.
+        Paths are relative to the repository folder, for example pipelines/example_pipeline.
+        :param root: The repository folder, the first entry of the files list.
+        """
+        self.root = root
+        self.nodes: dict[str, dict] = {}
+        self.by_name: dict[str, list[str]] = {}
+
+        # Preorder walk so find returns the paths in the same order as a recursive search of the tree
+        stack = [(child, child["name"]) for child in reversed(root.get("children", []))]
+        while stack:
+            node, path = stack.pop()
+            self.nodes[path] = node
+            self.by_name.setdefault(node["name"], []).append(path)
+            stack.extend((child, f"{path}/{child['name']}") for child in reversed(node.get("children", [])))
+
+    def get(self, path: str) -> dict | None:
+        return self.nodes.get(path.strip("/"))
+
+    def children(self, path: str) -> list[dict]:
+        node = self.get(path)
+        return node.get("children", []) if node is not None else []
+
+    def find(self, name: str) -> list[str]:
+        return self.by_name.get(name, [])
+
+
+async def _download_tree(local_token: str) -> FileTree | None:
+    url = f'{os.getenv("BASE_URL")}/api/files?include_pipeline_count=true&api_key={os.getenv("API_KEY")}'
+
+    headers = {
+        "Authorization": f"Bearer {local_token}"
+    }
+
+    response = await mage_client.request("GET", url, headers=headers)
+
+    if response.status_code not in [200, 304] or response.json().get("error"):
+        return None
+
+    files = response.json().get("files", [])
+    if len(files) == 0:
+        return None
+
+    return FileTree(files[0])
+
+
+async def get_file_tree(local_token: str, force: bool = False) -> FileTree | None:
+    """
+    Returns the indexed Mage file tree, downloading it only when the cached one expired or was invalidated.
+    :param local_token: The token used to authenticate to Mage.
+    :param force: Ignore the cached tree and download it again.
+    """
+    if not force:
+        tree = local_cache.get(FILE_TREE_KEY)
+        if tree is not None:
+            return tree
+
+    async with _lock:
+        if not force:
+            tree = local_cache.get(FILE_TREE_KEY)
+            if tree is not None:
+                return tree
+
+        tree = await _download_tree(local_token)
+        if tree is not None:
+            local_cache.set(FILE_TREE_KEY, tree, ttl_seconds=FILE_TREE_TTL)
+
+        return tree
+
+
+def invalidate_file_tree() -> None:
+    # Also drops the tree of the other workers through the invalidation channel
+    delete_entries(FILE_TREE_KEY)
@@ -1,28 +1,167 @@
+import os
+import json
 import yaml
-from typing import List, Dict, Any
-from mage_to_cwl.mage_to_python import MageToPython
+import hashlib
+import threading
+import multiprocessing
+from typing import List, Dict, Any, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from mage_to_cwl.mage_to_python import MageToPython, FORMATTER
+
+# Part of every cache key built from the conversion, bump it whenever the generated files change
+CONVERTER_VERSION = "6"
+
+# The blocks are converted on a pool of processes shared by all the exports, created on first use
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _workers() -> int:
+    return int(os.getenv("CWL_WORKERS", str(os.cpu_count() or 1)))
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # The pool is created from a worker thread of a process that also runs the event loop and the Redis
+            # listener, forking it could leave a lock held in the children, so the workers are spawned instead
+            _pool = ProcessPoolExecutor(max_workers=_workers(), mp_context=multiprocessing.get_context("spawn"))
+
+        return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def _convert_block(code_string: str, block_name: str, repo_name: str, upstream_block_names: List[str]) -> Tuple[str, List[str]]:
+    entry = MageToPython(code_string, block_name, repo_name, upstream_block_names)
+    entry.mage_to_python()
+    return entry.code_string, entry.env_vars
+
+
+def get_upstream_block_names(blocks: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """
+    Returns the upstream blocks of every block, from both the upstream_blocks and downstream_blocks of the pipeline.
+    They are kept in the order of upstream_blocks, which is the order Mage passes their outputs to the block.
+    :param blocks: The blocks of the pipeline.
+    """
+    uuids = {block["uuid"] for block in blocks}
+    upstream = {block["uuid"]: [name for name in block.get("upstream_blocks", []) if name in uuids] for block in blocks}
+
+    for block in blocks:
+        for name in block.get("downstream_blocks", []):
+            if name in uuids and block["uuid"] not in upstream[name]:
+                upstream[name].append(block["uuid"])
+
+    return upstream
+
+
+def topological_sort(blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Orders the blocks so every block comes after all its upstream blocks, using Kahn's algorithm.
+    Blocks that don't depend on each other keep the order they have in the pipeline.
+    :param blocks: The blocks of the pipeline.
+    """
+    upstream = get_upstream_block_names(blocks)
+
+    downstream = {block["uuid"]: [] for block in blocks}
+    for uuid, names in upstream.items():
+        for name in names:
+            downstream[name].append(uuid)
+
+    by_uuid = {block["uuid"]: block for block in blocks}
+    in_degree = {uuid: len(names) for uuid, names in upstream.items()}
+    ready = deque(block["uuid"] for block in blocks if in_degree[block["uuid"]] == 0)
+
+    ordered = []
+    while ready:
+        uuid = ready.popleft()
+        ordered.append(by_uuid[uuid])
+        for name in downstream[uuid]:
+            in_degree[name] -= 1
+            if in_degree[name] == 0:
+                ready.append(name)
+
+    if len(ordered) < len(blocks):
+        raise ValueError("The blocks of the pipeline contain a cycle!")
+
+    return ordered
 
 
 class MageToCWL:
     def __init__(self, blocks: List[Dict[str, Any]], pipeline_name: str, repo_name: str) -> None:
-        if len(blocks[0]["upstream_blocks"]) > 0:
-            raise ValueError("First block must not have an upstream_block!")
-        self.blocks = blocks
+        self.blocks = topological_sort(blocks)
         self.results: List[MageToPython] = []
         self.files = {f"{pipeline_name}/scripts/requirements/": None}
         self.pipeline_name = pipeline_name
         self.repo_name = repo_name
+        upstream = get_upstream_block_names(self.blocks)
+        self.upstream_block_names = [upstream[block["uuid"]] for block in self.blocks]
+        # Blocks whose output is not used by another block write the final output of the workflow
+        used = {name for names in self.upstream_block_names for name in names}
+        self.sinks = {block["uuid"] for block in self.blocks if block["uuid"] not in used}
+        self.block_fingerprints = [self._block_fingerprint(block, upstream_block_names)
+                                   for block, upstream_block_names in zip(self.blocks, self.upstream_block_names)]
+        # Blocks converted by the last call to process, by fingerprint, so the caller can cache them
+        self.converted: Dict[str, Dict[str, Any]] = {}
+
+    def _block_fingerprint(self, block: Dict[str, Any], upstream_block_names: List[str]) -> str:
+        content = json.dumps([CONVERTER_VERSION, FORMATTER, self.repo_name, block["uuid"], upstream_block_names, block["content"]])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of everything the generated files depend on, the same fingerprint always produces the same files.
+        """
+        content = json.dumps([CONVERTER_VERSION, self.pipeline_name, self.block_fingerprints])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _convert_blocks(self, pending: List[Tuple[Dict[str, Any], List[str]]]) -> List[Tuple[str, List[str]]]:
+        if len(pending) < 2 or _workers() < 2:
+            return [_convert_block(block["content"], block["uuid"], self.repo_name, upstream_block_names)
+                    for block, upstream_block_names in pending]
 
-    def _transform_mage_to_python(self) -> None:
-        for i, block in enumerate(self.blocks):
-            if i == 0:
-                entry = MageToPython(block["content"], block["uuid"], self.repo_name)
-                entry.mage_to_python()
-                self.results.append(entry)
-            else:
-                entry = MageToPython(block["content"], block["uuid"], self.repo_name, self.results[i-1].block_name)
-                entry.mage_to_python()
-                self.results.append(entry)
+        try:
+            # Every block only depends on the names of its upstream blocks, which are known up front
+            futures = [_get_pool().submit(_convert_block, block["content"], block["uuid"], self.repo_name, upstream_block_names)
+                       for block, upstream_block_names in pending]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A worker died, the pool can't be used anymore so it is replaced on the next export
+            shutdown_pool()
+            return [_convert_block(block["content"], block["uuid"], self.repo_name, upstream_block_names)
+                    for block, upstream_block_names in pending]
+
+    def _transform_mage_to_python(self, converted_blocks: Dict[str, Dict[str, Any]]) -> None:
+        blocks = list(zip(self.blocks, self.upstream_block_names, self.block_fingerprints))
+        pending = [(block, upstream_block_names) for block, upstream_block_names, fingerprint in blocks
+                   if fingerprint not in converted_blocks]
+        pending_fingerprints = [fingerprint for _, _, fingerprint in blocks if fingerprint not in converted_blocks]
+
+        for fingerprint, (code_string, env_vars) in zip(pending_fingerprints, self._convert_blocks(pending)):
+            self.converted[fingerprint] = {
+                "code_string": code_string,
+                "env_vars": env_vars
+            }
+
+        for block, upstream_block_names, fingerprint in blocks:
+            converted = converted_blocks.get(fingerprint) or self.converted[fingerprint]
+
+            entry = MageToPython(block["content"], block["uuid"], self.repo_name, upstream_block_names)
+            entry.code_string = converted["code_string"]
+            entry.env_vars = converted["env_vars"]
+            self.results.append(entry)
 
     class QuotedString(str):
         pass
@@ -36,7 +175,7 @@ class MageToCWL:
         return dumper.represent_sequence('tag:yaml.org,2002:seq', data, flow_style=True)
 
     @staticmethod
-    def _first_step_template() -> str:
+    def _step_template() -> str:
         string = """
         cwlVersion: v1.2
         class: CommandLineTool
@@ -65,7 +204,7 @@ class MageToCWL:
           - valueFrom: |
               set -e && \
               export PYTHONPATH=$(inputs.scripts_directory.path)/requirements:$(inputs.scripts_directory.path)/utils:$PYTHONPATH && \
-              python3 $(inputs.scripts_directory.path)/$(inputs.block_name_script)
+              python3 $(inputs.scripts_directory.path)/$(inputs.block_name_script)upstream_results
         
           - position: 0
             prefix: --
@@ -74,88 +213,43 @@ class MageToCWL:
         return string
 
     @staticmethod
-    def _step_template() -> str:
-        string = """
-        cwlVersion: v1.2
-        class: CommandLineTool
-        baseCommand: [bash, -c]
-        id:
-        requirements:
-          InlineJavascriptRequirement: {}
+    def _output_file(result: MageToPython) -> str:
+        # Data exporters always write final_output, the other blocks write to the file named by their OUTPUT_FILE variable
+        if f"{result.block_name.upper()}_OUTPUT_FILE" in (result.env_vars or []):
+            return f"{result.block_name}_result"
+        return "final_output"
 
-        inputs:
-          block_name_script:
-            type: string
-            inputBinding:
-              position: 1
-          prev_block_name_result:
-            type: File
-            inputBinding:
-              position: 2
-          scripts_directory:
-            type: Directory
-            inputBinding:
-              position: 3
+    def _final_output(self, block_name: str) -> str:
+        # With more than one final block every one of them gets its own workflow output
+        return "final_output" if len(self.sinks) == 1 else f"{block_name}_final_output"
 
-        outputs:
-          block_name_result:
-            type: File
-            outputBinding:
-              glob: block_name_result
-              
-        arguments:
-          - valueFrom: |
-              set -e && \
-              export PYTHONPATH=$(inputs.scripts_directory.path)/requirements:$(inputs.scripts_directory.path)/utils:$PYTHONPATH && \
-              python3 $(inputs.scripts_directory.path)/$(inputs.block_name_script) $(inputs.prev_block_name_result.path)
-        
-          - position: 0
-            prefix: --
-            valueFrom: ""
-        """
-        return string
+    def _step(self, block_name: str, upstream_block_names: List[str], output_file: str) -> str:
+        template = self._step_template()
+        template = template.replace("block_name_result", output_file)
+        template = template.replace("block_name", block_name)
+        template = template.replace("id:", f"id: {block_name}")
+        template = template.replace("upstream_results", "".join(f" $(inputs.{name}_result.path)" for name in upstream_block_names))
 
-    @staticmethod
-    def _last_step_template() -> str:
-        string = """
-            cwlVersion: v1.2
-            class: CommandLineTool
-            baseCommand: [bash, -c]
-            id:
-            requirements:
-              InlineJavascriptRequirement: {}
-
-            inputs:
-              block_name_script:
-                type: string
-                inputBinding:
-                  position: 1
-              prev_block_name_result:
-                type: File
-                inputBinding:
-                  position: 2
-              scripts_directory:
-                type: Directory
-                inputBinding:
-                  position: 3
-                  
-            outputs:
-              final_output:
-                type: File
-                outputBinding:
-                  glob: final_output
-
-            arguments:
-              - valueFrom: |
-                  set -e && \
-                  export PYTHONPATH=$(inputs.scripts_directory.path)/requirements:$(inputs.scripts_directory.path)/utils:$PYTHONPATH && \
-                  python3 $(inputs.scripts_directory.path)/$(inputs.block_name_script) $(inputs.prev_block_name_result.path)
-
-              - position: 0
-                prefix: --
-                valueFrom: ""
-            """
-        return string
+        step = yaml.safe_load(template)
+
+        # The results of the upstream blocks are passed to the script in order, between the script and the scripts directory
+        scripts_directory = step["inputs"].pop("scripts_directory")
+        for i, name in enumerate(upstream_block_names):
+            step["inputs"][f"{name}_result"] = {
+                "type": "File",
+                "inputBinding": {
+                    "position": i + 2
+                }
+            }
+        scripts_directory["inputBinding"]["position"] = len(upstream_block_names) + 2
+        step["inputs"]["scripts_directory"] = scripts_directory
+
+        # The file written by a final block is renamed to its workflow output, so several final blocks don't collide
+        if block_name in self.sinks and output_file != self._final_output(block_name):
+            step["outputs"][output_file]["outputBinding"]["outputEval"] = \
+                f'${{ self[0].basename = "{self._final_output(block_name)}"; return self[0]; }}'
+
+        return yaml.safe_dump(step, default_flow_style=False, sort_keys=False)
 
     @staticmethod
     def _inputs() -> Any:
@@ -194,23 +288,40 @@ import os
 import matplotlib.pyplot as plt
 import argparse
 
-def display_data(file_path):
+def load_data(file_path):
+    with open(file_path, 'rb') as file:
+        magic = file.read(6)
+
+    # DataFrames returned by the final blocks are written as Arrow IPC files, everything else is pickled
+    if magic == b'ARROW1':
+        import pyarrow.feather as feather
+        return feather.read_feather(file_path)
+
     with open(file_path, 'rb') as file:
-        data = pickle.load(file)
-    
+        return pickle.load(file)
+
+def display_data(file_path):
+    data = load_data(file_path)
+
+    # Data exporters save their variables by name, the other final blocks save the value they return
+    if not isinstance(data, dict):
+        data = {os.path.basename(file_path): data}
+
     for var_name, var_value in data.items():
         if isinstance(var_value, plt.Figure):
             os.makedirs("./figures", exist_ok=True)
-            plt.savefig(f"./figures/{var_name}.png")
+            var_value.savefig(f"./figures/{var_name}.png")
         else:
             print(f"{var_name}: {var_value}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Display data from a pickle file.")
-    parser.add_argument('-f', '--file', required=True, help='Path to the pickle file')
+    parser = argparse.ArgumentParser(description="Display data from the output files of the workflow.")
+    parser.add_argument('-f', '--file', required=True, nargs='+', help='Paths to the output files')
 
     args = parser.parse_args()
-    display_data(args.file)
+    for file_path in args.file:
+        print(f"--- {file_path}")
+        display_data(file_path)
 """
         return string
 
@@ -235,69 +346,50 @@ if [ -z "$(ls -A "$DIR")" ]; then
     pip install --target ./scripts/requirements -r ./scripts/requirements/requirements_parsed.txt
 fi
 
-cwltool workflow.cwl inputs.yml && pip install --target ./scripts/requirements matplotlib && export PYTHONPATH=./scripts/requirements:./scripts:$PYTHONPATH && python3 result_displayer.py -f final_output
+cwltool workflow.cwl inputs.yml && pip install --target ./scripts/requirements matplotlib && export PYTHONPATH=./scripts/requirements:./scripts:$PYTHONPATH && python3 result_displayer.py -f *final_output
 """
         return string
 
-    def process(self) -> None:
-        self._transform_mage_to_python()
+    def process(self, converted_blocks: Dict[str, Dict[str, Any]] | None = None) -> None:
+        """
+        Converts the blocks and generates the CWL workflow files into self.files.
+        :param converted_blocks: Blocks converted before, by fingerprint, these are not converted again.
+        """
+        self._transform_mage_to_python(converted_blocks or {})
         yaml.representer.SafeRepresenter.add_representer(self.QuotedString, self._quoted_str_representer)
         yaml.representer.SafeRepresenter.add_representer(list, self._list_representer)
         inputs = self._inputs()
         workflow = self._workflow()
         self.files[f"{self.pipeline_name}/result_displayer.py"] = self._result_displayer()
         self.files[f"{self.pipeline_name}/run.sh"] = self._run_script()
-        for i, result in enumerate(self.results):
+        output_files = {result.block_name: self._output_file(result) for result in self.results}
+        for result in self.results:
             self.files[f"{self.pipeline_name}/scripts/{result.block_name}.py"] = result.code_string
             inputs[f"{result.block_name}_script"] = self.QuotedString(f"{result.block_name}.py")
             workflow["inputs"][f"{result.block_name}_script"] = {
                 "type": "string"
             }
-            if i == 0:
-                template = self._first_step_template().replace("block_name", result.block_name)
-                template = template.replace("id:", f"id: {result.block_name}")
-                workflow["steps"][result.block_name] = {
-                    "run": f"./steps/{result.block_name}.cwl",
-                    "in": {
-                        f"{result.block_name}_script": f"{result.block_name}_script",
-                        "scripts_directory": "scripts_folder",
-                    },
-                    "out": [f"{result.block_name}_result"]
-                }
-            elif i == len(self.results) - 1:
-                template = self._last_step_template()
-                template = template.replace("prev_block_name", result.previous_block_name)
-                template = template.replace("block_name", result.block_name)
-                template = template.replace("id:", f"id: {result.block_name}")
-                workflow["steps"][result.block_name] = {
-                    "run": f"./steps/{result.block_name}.cwl",
-                    "in": {
-                        f"{result.block_name}_script": f"{result.block_name}_script",
-                        f"{result.previous_block_name}_result": f"{result.previous_block_name}/{result.previous_block_name}_result",
-                        "scripts_directory": "scripts_folder"
-                    },
-                    "out": ["final_output"]
-                }
-                workflow["outputs"]["final_output"] = {
+
+            # Steps only wait for their own upstream blocks, so independent branches can run in parallel
+            step_inputs = {f"{result.block_name}_script": f"{result.block_name}_script"}
+            for name in result.upstream_block_names:
+                step_inputs[f"{name}_result"] = f"{name}/{output_files[name]}"
+            step_inputs["scripts_directory"] = "scripts_folder"
+
+            output = output_files[result.block_name]
+            workflow["steps"][result.block_name] = {
+                "run": f"./steps/{result.block_name}.cwl",
+                "in": step_inputs,
+                "out": [output]
+            }
+
+            if result.block_name in self.sinks:
+                workflow["outputs"][self._final_output(result.block_name)] = {
                     "type": "File",
-                    "outputSource": f"{result.block_name}/final_output"
-                }
-            else:
-                template = self._step_template()
-                template = template.replace("prev_block_name", result.previous_block_name)
-                template = template.replace("block_name", result.block_name)
-                template = template.replace("id:", f"id: {result.block_name}")
-                workflow["steps"][result.block_name] = {
-                    "run": f"./steps/{result.block_name}.cwl",
-                    "in": {
-                        f"{result.block_name}_script": f"{result.block_name}_script",
-                        f"{result.previous_block_name}_result": f"{result.previous_block_name}/{result.previous_block_name}_result",
-                        "scripts_directory": "scripts_folder"
-                    },
-                    "out": [f"{result.block_name}_result"]
+                    "outputSource": f"{result.block_name}/{output}"
                 }
 
-            self.files[f"{self.pipeline_name}/steps/{result.block_name}.cwl"] = yaml.safe_dump(yaml.safe_load(template), default_flow_style=False, sort_keys=False)
+            self.files[f"{self.pipeline_name}/steps/{result.block_name}.cwl"] = self._step(result.block_name, result.upstream_block_names, output)
 
             for env in result.env_vars:
                 if "OUTPUT_FILE" in env:
@@ -1,13 +1,38 @@
 from mage_to_cwl.mage_to_python_utils import remove_imports_with_word, replace_code_patterns
-from pathlib import Path
-import tempfile
+from functools import lru_cache
 import autopep8
 import black
 import os
 
+FORMATTERS = ("both", "black", "autopep8", "none")
+
+# none skips formatting to make the conversion faster
+FORMATTER = os.getenv("CWL_FORMATTER", "both")
+
+if FORMATTER not in FORMATTERS:
+    raise ValueError(f"CWL_FORMATTER should be one of {', '.join(FORMATTERS)}, not {FORMATTER}!")
+
+FORMAT_CACHE_SIZE = int(os.getenv("CWL_FORMAT_CACHE_SIZE", "512"))
+
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _format_autopep8(code_string: str) -> str:
+    try:
+        return autopep8.fix_code(code_string)
+    except Exception as _:
+        return code_string
+
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _format_black(code_string: str) -> str:
+    try:
+        return black.format_str(code_string, mode=black.Mode())
+    except Exception as _:
+        return code_string
+
 
 class MageToPython:
-    def __init__(self, code_string: str, block_name: str, repo_name: str, previous_block_name: str = None) -> None:
+    def __init__(self, code_string: str, block_name: str, repo_name: str, upstream_block_names: list[str] = None) -> None:
         """
         Initializer function for MageToPython class.
         :param code_string: The string that contains the Mage AI formatted Python code .
@@ -15,58 +40,26 @@ class MageToPython:
         self.code_string = code_string
         self.env_vars = None
         self.block_name = block_name
-        self.previous_block_name = previous_block_name
+        self.upstream_block_names = upstream_block_names or []
         self.repo_name = repo_name
 
     def _format_code_autopep8(self) -> None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".py") as tmp_file:
-            tmp_file_path = tmp_file.name
-            tmp_file.write(self.code_string.encode())
-            tmp_file.close()
-
-            try:
-                formatted_code = autopep8.fix_file(tmp_file_path)
-                with open(tmp_file_path, 'w') as file:
-                    file.write(formatted_code)
-
-                with open(tmp_file_path, 'r') as file:
-                    formatted_code = file.read()
-
-                self.code_string = formatted_code
-            except Exception as _:
-                return
-            finally:
-                os.remove(tmp_file_path)
+        self.code_string = _format_autopep8(self.code_string)
 
     def _format_code_black(self) -> None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".py") as tmp_file:
-            tmp_file_path = tmp_file.name
-            tmp_file.write(self.code_string.encode())
-            tmp_file.close()
-
-            try:
-                black.format_file_in_place(
-                    Path(tmp_file_path), fast=False, mode=black.FileMode(), write_back=black.WriteBack.YES
-                )
-
-                with open(tmp_file_path, 'r') as file:
-                    formatted_code = file.read()
-
-                self.code_string = formatted_code
-            except Exception as _:
-                return
-            finally:
-                os.remove(tmp_file_path)
+        self.code_string = _format_black(self.code_string)
 
     def _remove_mage_imports(self) -> None:
         self.code_string, self.env_vars = replace_code_patterns(self.code_string, repo_name=self.repo_name)
-        self.code_string, env_vars = remove_imports_with_word(self.code_string, "mage_ai", self.block_name, self.previous_block_name)
+        self.code_string, env_vars = remove_imports_with_word(self.code_string, "mage_ai", self.block_name, self.upstream_block_names)
         self.env_vars = self.env_vars + env_vars
 
     def mage_to_python(self) -> None:
         self._remove_mage_imports()
-        self._format_code_autopep8()
-        self._format_code_black()
+        if FORMATTER in ["both", "autopep8"]:
+            self._format_code_autopep8()
+        if FORMATTER in ["both", "black"]:
+            self._format_code_black()
 
     def __str__(self):
         return f"MageToPython(code_string={self.code_string}, env_vars={self.env_vars})"
@@ -1,6 +1,7 @@
 import re
 import ast
 import pickle
+import builtins
 from typing import Optional, List
 
 
@@ -12,79 +13,147 @@ def is_picklable(obj):
         return False
 
 
+def _import_bindings(node):
+    # import a.b binds a, import a.b as c and from a import b as c bind c
+    return {alias.asname or alias.name.split(".")[0] for alias in node.names}
+
+
 class RemoveUnusedCode(ast.NodeTransformer):
-    def __init__(self):
+    def __init__(self, root, keep_imports=()):
+        """
+        Removes the unused functions, classes and imports and the calls to functions that are not defined.
+        The methods of a class that is kept are never removed.
+        The names used and bound in root are indexed once, so every check is a set lookup instead of a walk of the tree.
+        :param root: The module that is going to be visited.
+        :param keep_imports: Names whose imports are kept even if they are not used.
+        """
         super().__init__()
+        self.removed = 0
+        self.used = set(keep_imports)
+        self.bound = set(dir(builtins))
+        # Methods are called through attributes or implicitly, like __init__, so their names never show up as used
+        self.methods = set()
+
+        for node in ast.walk(root):
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    self.used.add(node.id)
+                else:
+                    self.bound.add(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                self.bound.add(node.name)
+                if isinstance(node, ast.ClassDef):
+                    self.methods.update(id(statement) for statement in node.body
+                                        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)))
+            elif isinstance(node, ast.arg):
+                self.bound.add(node.arg)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                self.bound.update(_import_bindings(node))
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                self.bound.update(node.names)
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                self.bound.add(node.name)
+
+    def _remove(self, message):
+        print(message)
+        self.removed += 1
+        return None
 
     def visit_FunctionDef(self, node):
-        if not any(isinstance(stmt, ast.Call) and isinstance(stmt.func, ast.Name) and stmt.func.id == node.name for stmt in ast.walk(self.root)):
-            print(f"Removing unused function {node.name}")
-            return None  
+        if id(node) not in self.methods and node.name not in self.used:
+            return self._remove(f"Removing unused function {node.name}")
 
         self.generic_visit(node)
         return node
 
     def visit_ClassDef(self, node):
-        if not any(isinstance(stmt, ast.Name) and stmt.id == node.name for stmt in ast.walk(self.root)):
-            print(f"Removing unused class {node.name}")
-            return None 
+        if node.name not in self.used:
+            return self._remove(f"Removing unused class {node.name}")
 
         self.generic_visit(node)
         return node
 
     def visit_Expr(self, node):
-        if isinstance(node.value, ast.Call):
-            func_name = None
-            if isinstance(node.value.func, ast.Name):
-                func_name = node.value.func.id
-            elif isinstance(node.value.func, ast.Attribute):
-                func_name = node.value.func.attr
-
-            if func_name and not any(
-                isinstance(stmt, (ast.FunctionDef, ast.ClassDef)) and stmt.name == func_name for stmt in ast.walk(self.root)
-            ):
-                print(f"Removing call to undefined function or class method {func_name}")
-                return None  
+        if isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Name) and node.value.func.id not in self.bound:
+            return self._remove(f"Removing call to undefined function {node.value.func.id}")
 
         return self.generic_visit(node)
 
     def visit_Import(self, node):
-        imported_names = {alias.name for alias in node.names}
-        if not any(isinstance(stmt, ast.Name) and stmt.id in imported_names for stmt in ast.walk(self.root)):
-            print(f"Removing unused import {', '.join(imported_names)}")
-            return None
+        imported_names = _import_bindings(node)
+        if not imported_names & self.used:
+            return self._remove(f"Removing unused import {', '.join(alias.name for alias in node.names)}")
 
-        return self.generic_visit(node)
+        return node
 
     def visit_ImportFrom(self, node):
-        imported_names = {alias.name for alias in node.names}
-        if not any(isinstance(stmt, ast.Name) and stmt.id in imported_names for stmt in ast.walk(self.root)):
-            print(f"Removing unused import from {node.module}: {', '.join(imported_names)}")
-            return None
+        if node.module == "__future__" or any(alias.name == "*" for alias in node.names):
+            return node
 
-        return self.generic_visit(node)
+        imported_names = _import_bindings(node)
+        if not imported_names & self.used:
+            return self._remove(f"Removing unused import from {node.module}: {', '.join(alias.name for alias in node.names)}")
 
-    def visit_Module(self, node):
-        self.root = node
-        node.body = [self.visit(stmt) for stmt in node.body if stmt is not None]
         return node
 
-def remove_unused_code(code):
+
+def _fill_empty_bodies(tree):
+    # A block whose every statement was removed still needs a statement to be valid Python
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Module) and isinstance(getattr(node, "body", None), list) and len(node.body) == 0:
+            node.body.append(ast.Pass())
+
+
+def remove_unused_code(code, keep_imports=()):
     try:
         tree = ast.parse(code)
 
-        transformer = RemoveUnusedCode()
-        sanitized_tree = transformer.visit(tree)
+        # Removing a symbol can leave other symbols unused, so the pass is repeated until nothing else is removed
+        while True:
+            transformer = RemoveUnusedCode(tree, keep_imports)
+            tree = transformer.visit(tree)
+            if transformer.removed == 0:
+                break
 
-        sanitized_code = ast.unparse(sanitized_tree)
+        _fill_empty_bodies(tree)
+
+        sanitized_code = ast.unparse(tree)
         return sanitized_code
     except Exception as e:
         print(f"Error while removing unused code: {e}")
         return code
     
 
+# Added to the generated scripts that pass data between steps. DataFrames are written as uncompressed Arrow IPC
+# (Feather v2) files, which the next step memory maps instead of deserializing, everything else is pickled.
+BLOCK_OUTPUT_HELPERS = """
+def dump_block_output(value, path):
+    if type(value).__name__ == 'DataFrame' and type(value).__module__.startswith('pandas'):
+        try:
+            import pyarrow.feather as feather
+            feather.write_feather(value, path, compression='uncompressed')
+            return
+        except Exception:
+            pass
+    with open(path, 'wb') as file:
+        import pickle
+        pickle.dump(value, file)
+
+
+def load_block_output(path):
+    with open(path, 'rb') as file:
+        is_arrow = file.read(6) == b'ARROW1'
+    if is_arrow:
+        import pyarrow.feather as feather
+        return feather.read_feather(path, memory_map=True)
+    with open(path, 'rb') as file:
+        import pickle
+        return pickle.load(file)
+"""
+
+
 class MageToPythonTransformer(ast.NodeTransformer):
-    def __init__(self, word: str, decorators: List[str], block_name: str, previous_block_name: str) -> None:
+    def __init__(self, word: str, decorators: List[str], block_name: str, upstream_block_names: List[str]) -> None:
         self.word = word
         self.decorators = decorators
         self.collected_statements = []
@@ -93,8 +162,9 @@ class MageToPythonTransformer(ast.NodeTransformer):
         self.parent_stack = []
         self.first_arg_statements = []
         self.block_name = block_name
-        self.previous_block_name = previous_block_name
+        self.upstream_block_names = upstream_block_names
         self.pandas_import_needed = True
+        self.block_output_helpers_needed = False
         self.env_vars = []
 
     def visit_Import(self, node: ast.Import) -> Optional[ast.Import]:
@@ -173,39 +243,46 @@ if output_file:
                         write_to_file_code = f"""
 output_file = os.getenv("{function_name}")
 if output_file:
-    with open(output_file, 'wb') as file:
-        import pickle
-        pickle.dump({ast.unparse(return_var)}, file)
+    dump_block_output({ast.unparse(return_var)}, output_file)
 """
+                        self.block_output_helpers_needed = True
                         write_to_file_ast = ast.parse(write_to_file_code).body
                         node.body[i:i + 1] = write_to_file_ast
                         if isinstance(return_var, ast.Attribute) and return_var.attr == 'DataFrame':
                             self.pandas_import_needed = True
                 self.collected_statements.extend(node.body)
 
-            if len(node.args.args) > 0 and node.args.args[0].arg != '*args':
-                first_arg = node.args.args[0].arg
-                read_file_code = f"""
+            # Mage passes the output of every upstream block as a positional argument, in the order of upstream_blocks,
+            # the outputs past the named arguments go to *args. The parser locals are prefixed so they can't shadow the block's names
+            positional_args = [arg.arg for arg in node.args.args]
+            vararg = node.args.vararg.arg if node.args.vararg is not None else None
+            if len(positional_args) > 0 or vararg is not None:
+                read_file_code = """
 import argparse
-parser = argparse.ArgumentParser()
-parser.add_argument('filename')
-args = parser.parse_args()
-
-{first_arg} = None
-if args.filename:
-    with open(args.filename, 'rb') as file:
-        import pickle
-        {first_arg} = pickle.load(file)
+_parser = argparse.ArgumentParser()
+_parser.add_argument('filenames', nargs='*')
+_cli = _parser.parse_args()
 """
-                self.first_arg_statements.append(ast.parse(read_file_code).body)
+                for i, arg in enumerate(positional_args):
+                    read_file_code += f"""
+{arg} = None
+if len(_cli.filenames) > {i}:
+    {arg} = load_block_output(_cli.filenames[{i}])
+"""
+                if vararg is not None:
+                    read_file_code += f"""
+{vararg} = tuple(load_block_output(filename) for filename in _cli.filenames[{len(positional_args)}:])
+"""
+                self.block_output_helpers_needed = True
+                self.first_arg_statements.extend(ast.parse(read_file_code).body)
             return None
         return node
 
 
-def remove_imports_with_word(code_string: str, word: str, block_name: str, previous_block_name: str) -> (str, list[str], str):
+def remove_imports_with_word(code_string: str, word: str, block_name: str, upstream_block_names: List[str]) -> (str, list[str], str):
     tree = ast.parse(code_string)
     transformer = MageToPythonTransformer(word, ["data_loader", "transformer", "data_exporter", "sensor", "custom"],
-                                          block_name=block_name, previous_block_name=previous_block_name)
+                                          block_name=block_name, upstream_block_names=upstream_block_names)
     cleaned_tree = transformer.visit(tree)
     cleaned_tree = ast.fix_missing_locations(cleaned_tree)
 
@@ -232,6 +309,10 @@ def remove_imports_with_word(code_string: str, word: str, block_name: str, previ
     if_main_node.body = transformer.first_arg_statements + if_main_node.body
     if_main_node.body.extend(transformer.collected_statements)
 
+    if transformer.block_output_helpers_needed:
+        index = cleaned_tree.body.index(if_main_node)
+        cleaned_tree.body[index:index] = ast.parse(BLOCK_OUTPUT_HELPERS).body
+
     if transformer.os_import_needed:
         os_import = ast.Import(names=[ast.alias(name='os', asname=None)])
         cleaned_tree.body.insert(0, os_import)
@@ -241,7 +322,8 @@ def remove_imports_with_word(code_string: str, word: str, block_name: str, previ
         cleaned_tree.body.insert(1, pandas_import)
 
     cleaned_code = ast.unparse(cleaned_tree)
-    cleaned_code = remove_unused_code(cleaned_code)
+    # pandas and matplotlib are imported on purpose so pipreqs installs what is needed to unpickle the results
+    cleaned_code = remove_unused_code(cleaned_code, keep_imports=["pd", "plt"])
     return cleaned_code, transformer.env_vars
 
 
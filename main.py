@@ -12,10 +12,14 @@ from langchain.schema import Document
 from pydantic import ValidationError
 from routers.logs import logs_get
 from routers.validate import sock
+from mage_client.client import close_client
+from mage_to_cwl.mage_to_cwl import shutdown_pool
+from utils.log_stream import stop_pollers
+from dependencies import token
+from redis_cache.cache import start_invalidation_listener, stop_invalidation_listener
 from rag.data import add_document
 from typing import Annotated
 import asyncio
-import uvicorn
 import os
 
 app = FastAPI(openapi_url="/mage/openapi.json", docs_url="/mage/docs", title="MageAPI")
@@ -26,6 +30,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(pipelines_get.router)
@@ -57,6 +62,22 @@ app.include_router(websock.router)
 app.include_router(sock.router)
 
 
+@app.on_event("startup")
+async def startup():
+    await token.update_token()
+    token.start_refresher()
+    start_invalidation_listener()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await token.stop_refresher()
+    stop_pollers()
+    stop_invalidation_listener()
+    shutdown_pool()
+    await close_client()
+
+
 @app.get("/mage")
 async def entry():
     return JSONResponse(content="Hello from server!", status_code=200)
@@ -81,6 +102,9 @@ async def server_set(server: Server):
         os.environ["EMAIL"] = server.email
     if server.password is not None:
         os.environ["PASSWORD"] = server.password
+
+    await token.update_token(force=True)
+
     return JSONResponse(content="Changed configuration to new Mage server!", status_code=200)
 
 
@@ -138,32 +162,3 @@ async def rag_endpoint(websocket: WebSocket):
 
     await websocket.close()
 
-
-if __name__ == '__main__':
-    # If .env exists locally, use that for environment variables
-    # In a docker image is built ignoring the .env so it can't appear in a container
-    if os.path.exists(".env"):
-        from dotenv import load_dotenv
-        load_dotenv(".env")
-
-
-    if os.getenv('AUTH') is None:
-        print("AUTH env variable is required can be [true, false]")
-        exit(1)
-    else:
-        if os.getenv('AUTH') == 'true':
-            if os.getenv('EMAIL') is None or os.getenv('PASSWORD') is None:
-                print("EMAIL or PASSWORD env variable not provided. If AUTH is true they are required!")
-                exit(1)
-
-    if os.getenv('BASE_URL') is None:
-        print("BASE_URL env variable is required!")
-        exit(1)
-
-    if os.getenv('OLLAMA_URL') is None:
-        print("OLLAMA_URL env variable is required!")
-        exit(1)
-
-    os.environ["API_KEY"] = "zkWlN0PkIKSN0C11CfUHUj84OT5XOJ6tDZ6bDRO2"
-
-    uvicorn.run(app, host="0.0.0.0", ws_ping_timeout=1000.0)
@@ -1,24 +1,262 @@
 import os
+import uuid
+import asyncio
 from redis import StrictRedis
+from redis.exceptions import RedisError
 from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+from redis_cache.local_cache import LocalCache
+from redis_cache import codec
 
 redis_client = StrictRedis(host=os.getenv("LOCAL_IP"), port=6379, db=0)
 
-def get_data_from_redis(key):
-    return redis_client.get(key)
+# Per worker cache in front of Redis, kept coherent through the invalidation channel
+local_cache = LocalCache(max_entries=int(os.getenv("LOCAL_CACHE_SIZE", "256")),
+                         ttl_seconds=float(os.getenv("LOCAL_CACHE_TTL", "30")))
 
+INVALIDATION_CHANNEL = "cache:invalidate"
 
-def set_data_in_redis(key, value, expire_time_seconds):
-    redis_client.setex(key, expire_time_seconds, value)
+# Identifies this worker on the invalidation channel so it skips its own messages
+_instance_id = uuid.uuid4().hex
 
-def is_data_stale(key, expire_time_seconds):
-    last_update_time_str = redis_client.get(f"{key}_timestamp")
-    if last_update_time_str:
-        last_update_time = datetime.fromisoformat(last_update_time_str.decode())
-        current_time = datetime.utcnow()
-        return (current_time - last_update_time) > timedelta(seconds=expire_time_seconds)
-    return True
+_invalidation_thread = None
+
+# Keeps a reference to the running background refreshes so they are not garbage collected
+_background_tasks = set()
+
+# Computations running in this worker, concurrent callers for the same key await the same future
+_inflight: dict[str, asyncio.Task] = {}
+
+# Deletes the lock only if it is still owned by the caller, so an expired lease can't release someone else's
+_release_lock_script = redis_client.register_script("""
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+""")
+
+
+def _publish_invalidation(*keys):
+    for key in keys:
+        redis_client.publish(INVALIDATION_CHANNEL, f"{_instance_id} {key}")
+
+
+def _handle_invalidation(message):
+    instance_id, key = message["data"].decode().split(" ", 1)
+    if instance_id != _instance_id:
+        local_cache.delete(key)
+
+
+def start_invalidation_listener():
+    global _invalidation_thread
+
+    if _invalidation_thread is not None:
+        return
+
+    try:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _handle_invalidation})
+        _invalidation_thread = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+    except RedisError as e:
+        # Without the listener the local entries are only bounded by LOCAL_CACHE_TTL
+        print(f"Could not subscribe to the cache invalidation channel: {e}")
+
+
+def stop_invalidation_listener():
+    global _invalidation_thread
+
+    if _invalidation_thread is None:
+        return
 
-def update_timestamp(key):
+    _invalidation_thread.stop()
+    _invalidation_thread = None
+
+
+def get_entries(keys):
+    entries = {}
+    missing = []
+    for key in keys:
+        entry = local_cache.get(key)
+        if entry is not None:
+            entries[key] = entry
+        else:
+            missing.append(key)
+
+    if len(missing) > 0:
+        # The values and their timestamps are read in a single round trip
+        values = redis_client.mget(*[name for key in missing for name in (key, f"{key}_timestamp")])
+        for i, key in enumerate(missing):
+            value, last_update_time_str = values[2 * i], values[2 * i + 1]
+            if value is None:
+                continue
+
+            entry = (codec.decode(value),
+                     datetime.fromisoformat(last_update_time_str.decode()) if last_update_time_str is not None else None)
+            local_cache.set(key, entry)
+            entries[key] = entry
+
+    return entries
+
+
+def get_entry(key):
+    return get_entries([key]).get(key, (None, None))
+
+
+def set_entry(key, value, expire_time_seconds):
     current_time = datetime.utcnow()
-    redis_client.set(f"{key}_timestamp", current_time.isoformat())
+
+    pipe = redis_client.pipeline()
+    pipe.setex(key, expire_time_seconds, codec.encode(value))
+    pipe.setex(f"{key}_timestamp", expire_time_seconds, current_time.isoformat())
+    pipe.execute()
+
+    # An entry that expires sooner in Redis must not outlive it in the local cache
+    local_cache.set(key, (value, current_time), ttl_seconds=min(expire_time_seconds, local_cache.ttl_seconds))
+    _publish_invalidation(key)
+
+
+def delete_entries(*keys):
+    if len(keys) == 0:
+        return
+
+    redis_client.delete(*keys, *[f"{key}_timestamp" for key in keys])
+
+    for key in keys:
+        local_cache.delete(key)
+    _publish_invalidation(*keys)
+
+
+def acquire_lock(key, expire_time_seconds):
+    lease = uuid.uuid4().hex
+    if redis_client.set(f"{key}_lock", lease, nx=True, ex=expire_time_seconds):
+        return lease
+    return None
+
+
+def release_lock(key, lease):
+    _release_lock_script(keys=[f"{key}_lock"], args=[lease])
+
+
+async def _revalidate(key: str, compute: Callable[[], Awaitable[Any]], expire_time_seconds: int, lease: str) -> None:
+    try:
+        set_entry(key, await compute(), expire_time_seconds)
+    except Exception as e:
+        print(f"Failed to refresh the cache entry {key}: {e}")
+    finally:
+        release_lock(key, lease)
+
+
+async def _compute_with_lease(key: str,
+                              compute: Callable[[], Awaitable[Any]],
+                              expire_time_seconds: int,
+                              lease_seconds: int,
+                              is_valid: Callable[[Any], bool]) -> Any:
+    while True:
+        lease = acquire_lock(key, lease_seconds)
+        if lease is not None:
+            try:
+                # Another worker may have stored the value between the first check and taking the lease
+                value, _ = get_entry(key)
+                if value is not None and is_valid(value):
+                    return value
+
+                result = await compute()
+                set_entry(key, result, expire_time_seconds)
+                return result
+            finally:
+                release_lock(key, lease)
+
+        # Another worker holds the lease, wait for its result or for the lease to be released or to expire
+        while True:
+            await asyncio.sleep(0.1)
+            if redis_client.exists(f"{key}_lock") == 0:
+                value, _ = get_entry(key)
+                if value is not None and is_valid(value):
+                    return value
+                break
+
+
+async def get_or_compute(key: str,
+                         compute: Callable[[], Awaitable[Any]],
+                         expire_time_seconds: int,
+                         lease_seconds: int = 60,
+                         is_valid: Callable[[Any], bool] | None = None) -> Any:
+    """
+    Returns the cached value for key, computing it only once across all the workers when it is missing.
+    Inside a worker the concurrent callers share the same computation, between workers a Redis SET NX lease
+    elects the one that computes while the others wait for the value to be stored.
+    :param key: The Redis key of the entry.
+    :param compute: Coroutine function that builds the JSON serializable value.
+    :param expire_time_seconds: For how long the computed value is kept in Redis.
+    :param lease_seconds: After how long the lease of a worker that did not finish computing expires.
+    :param is_valid: Tells if a cached value can still be used, by default every cached value can.
+    """
+    if is_valid is None:
+        is_valid = _always_valid
+
+    value, _ = get_entry(key)
+    if value is not None and is_valid(value):
+        return value
+
+    # The computation runs in its own task, so a caller that is cancelled stops waiting without cancelling it
+    # for the other callers of the same key
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_compute_with_lease(key, compute, expire_time_seconds, lease_seconds, is_valid))
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _finish_inflight(key, done))
+
+    return await asyncio.shield(task)
+
+
+def _finish_inflight(key: str, task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+
+    # Mark the exception as retrieved in case every caller was cancelled before it was raised
+    if not task.cancelled():
+        task.exception()
+
+
+def _always_valid(_: Any) -> bool:
+    return True
+
+
+async def get_stale_while_revalidate(key: str,
+                                     compute: Callable[[], Awaitable[Any]],
+                                     fresh_seconds: int,
+                                     stale_seconds: int,
+                                     force: bool = False) -> Any:
+    """
+    Returns the cached value for key, computing it with compute when it is missing.
+    A value older than fresh_seconds is still returned as is for another stale_seconds, while a single
+    background refresh, guarded by a Redis lock shared by all the workers, replaces it.
+    :param key: The Redis key of the entry.
+    :param compute: Coroutine function that builds the JSON serializable value.
+    :param fresh_seconds: For how long the value is served without being refreshed.
+    :param stale_seconds: For how long after that the stale value can still be served.
+    :param force: Ignore the cached value and compute it again.
+    """
+    expire_time_seconds = fresh_seconds + stale_seconds
+
+    if not force:
+        value, last_update_time = get_entry(key)
+        if value is not None:
+            is_fresh = last_update_time is not None and \
+                datetime.utcnow() - last_update_time <= timedelta(seconds=fresh_seconds)
+
+            if not is_fresh:
+                lease = acquire_lock(key, fresh_seconds)
+                if lease is not None:
+                    task = asyncio.create_task(_revalidate(key, compute, expire_time_seconds, lease))
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+
+            return value
+
+        return await get_or_compute(key, compute, expire_time_seconds)
+
+    result = await compute()
+    set_entry(key, result, expire_time_seconds)
+
+    return result
@@ -0,0 +1,150 @@
+import os
+import json
+import zlib
+from typing import Any, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Every encoded value starts with this marker followed by the serializer and the compression ids,
+# values stored before the codec existed are plain JSON and never start with it
+MAGIC = b"\xffMC"
+
+JSON = 0
+ORJSON = 1
+MSGPACK = 2
+
+NONE = 0
+ZLIB = 1
+ZSTD = 2
+LZ4 = 3
+
+SERIALIZERS = {"json": JSON, "orjson": ORJSON, "msgpack": MSGPACK}
+COMPRESSIONS = {"none": NONE, "zlib": ZLIB, "zstd": ZSTD, "lz4": LZ4}
+
+
+def _default_serializer() -> int:
+    if msgpack is not None:
+        return MSGPACK
+    if orjson is not None:
+        return ORJSON
+    return JSON
+
+
+def _default_compression() -> int:
+    if zstandard is not None:
+        return ZSTD
+    if lz4_frame is not None:
+        return LZ4
+    return ZLIB
+
+
+_SERIALIZER_MODULES = {ORJSON: orjson, MSGPACK: msgpack}
+_COMPRESSION_MODULES = {ZSTD: zstandard, LZ4: lz4_frame}
+
+
+def _configured(variable: str, choices: dict[str, int], modules: dict[int, Any], default: Callable[[], int]) -> int:
+    name = os.getenv(variable)
+    if not name:
+        return default()
+
+    if name not in choices:
+        raise ValueError(f"{variable} should be one of {', '.join(choices)}, not {name}!")
+
+    value = choices[name]
+    if value in modules and modules[value] is None:
+        fallback = default()
+        print(f"{variable} is {name} but its package is not installed, "
+              f"using {next(key for key, choice in choices.items() if choice == fallback)} instead.")
+        return fallback
+
+    return value
+
+
+SERIALIZER = _configured("CACHE_SERIALIZER", SERIALIZERS, _SERIALIZER_MODULES, _default_serializer)
+COMPRESSION = _configured("CACHE_COMPRESSION", COMPRESSIONS, _COMPRESSION_MODULES, _default_compression)
+COMPRESSION_THRESHOLD = int(os.getenv("CACHE_COMPRESSION_THRESHOLD", "1024"))
+
+
+def _serialize(value: Any, serializer: int) -> bytes:
+    if serializer == MSGPACK:
+        return msgpack.packb(value, use_bin_type=True)
+    if serializer == ORJSON:
+        return orjson.dumps(value)
+    return json.dumps(value).encode()
+
+
+def _require(module: Any, name: str) -> Any:
+    # A value written by a worker that has a package this one is missing can't be read here
+    if module is None:
+        raise ValueError(f"The cache entry needs {name}, which is not installed!")
+    return module
+
+
+def _deserialize(data: bytes, serializer: int) -> Any:
+    if serializer == MSGPACK:
+        return _require(msgpack, "msgpack").unpackb(data, raw=False)
+    if serializer == ORJSON:
+        return _require(orjson, "orjson").loads(data)
+    if serializer == JSON:
+        return json.loads(data.decode())
+    raise ValueError(f"Unknown cache serializer {serializer}!")
+
+
+def _compress(data: bytes, compression: int) -> bytes:
+    if compression == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if compression == LZ4:
+        return lz4_frame.compress(data)
+    if compression == ZLIB:
+        return zlib.compress(data, 6)
+    return data
+
+
+def _decompress(data: bytes, compression: int) -> bytes:
+    if compression == ZSTD:
+        return _require(zstandard, "zstandard").ZstdDecompressor().decompress(data)
+    if compression == LZ4:
+        return _require(lz4_frame, "lz4").decompress(data)
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    if compression == NONE:
+        return data
+    raise ValueError(f"Unknown cache compression {compression}!")
+
+
+def encode(value: Any) -> bytes:
+    data = _serialize(value, SERIALIZER)
+
+    compression = NONE
+    if COMPRESSION != NONE and len(data) >= COMPRESSION_THRESHOLD:
+        compression = COMPRESSION
+        data = _compress(data, compression)
+
+    return MAGIC + bytes([SERIALIZER, compression]) + data
+
+
+def decode(data: bytes) -> Any:
+    if not data.startswith(MAGIC):
+        return json.loads(data.decode())
+
+    serializer, compression = data[len(MAGIC)], data[len(MAGIC) + 1]
+
+    return _deserialize(_decompress(data[len(MAGIC) + 2:], compression), serializer)
@@ -0,0 +1,51 @@
+import time
+import threading
+from typing import Any
+from collections import OrderedDict
+
+
+class LocalCache:
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        """
+        Bounded in-memory LRU cache whose entries also expire after ttl_seconds.
+        It is shared between the event loop and the Redis invalidation thread, so every access takes a lock.
+        :param max_entries: Maximum number of entries kept, 0 disables the cache.
+        :param ttl_seconds: For how long an entry is kept, bounds the staleness if an invalidation is missed.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl_seconds: float | None = None) -> None:
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds), value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,59 @@
+from redis_cache.cache import redis_client, get_entries, delete_entries
+
+# The uuid and updated_at of every pipeline, used to answer the contains queries
+PIPELINES_LIST_KEY = "pipelines_list"
+
+# Set with the uuid of every pipeline that has a cached pipeline:{uuid} entry
+PIPELINES_INDEX_KEY = "pipelines_index"
+
+
+def pipeline_key(uuid: str) -> str:
+    return f"pipeline:{uuid}"
+
+
+def get_cached_pipelines(uuids: list[str]) -> dict[str, dict]:
+    """
+    Returns the cached entries of the given pipelines, the ones that are not cached are missing from the result.
+    :param uuids: The uuids of the pipelines.
+    """
+    entries = get_entries([pipeline_key(uuid) for uuid in uuids])
+
+    return {uuid: entries[pipeline_key(uuid)][0] for uuid in uuids if pipeline_key(uuid) in entries}
+
+
+def index_pipelines(*uuids: str) -> None:
+    if len(uuids) > 0:
+        redis_client.sadd(PIPELINES_INDEX_KEY, *uuids)
+
+
+def invalidate_pipelines(*names: str) -> None:
+    """
+    Drops the cached entries of the given pipelines and the pipelines list.
+    :param names: The uuids of the created, renamed, updated or deleted pipelines.
+    """
+    if len(names) > 0:
+        redis_client.srem(PIPELINES_INDEX_KEY, *names)
+
+    delete_entries(PIPELINES_LIST_KEY, *[pipeline_key(name) for name in names])
+
+
+def invalidate_all_pipelines() -> None:
+    # New pipelines have no entry yet, so refreshing the list is enough to make them visible
+    delete_entries(PIPELINES_LIST_KEY)
+
+
+def invalidate_block(block_name: str) -> None:
+    """
+    Drops the cached pipelines that have a block named block_name, used when the pipeline is not known.
+    :param block_name: The uuid of the updated block.
+    """
+    uuids = [uuid.decode() for uuid in redis_client.smembers(PIPELINES_INDEX_KEY)]
+    cached = get_cached_pipelines(uuids)
+
+    expired = [uuid for uuid in uuids if uuid not in cached]
+    affected = [uuid for uuid, entry in cached.items()
+                if any(block["name"] == block_name for block in entry["pipeline"]["blocks"])]
+
+    if len(expired) + len(affected) > 0:
+        redis_client.srem(PIPELINES_INDEX_KEY, *expired, *affected)
+    delete_entries(*[pipeline_key(uuid) for uuid in affected])
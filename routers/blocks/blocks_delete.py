@@ -1,31 +1,31 @@
 import os
-import requests
-from dependencies import Token
+import mage_client.client as mage_client
+from dependencies import token
 from utils.models import DeleteBlock
 from fastapi import APIRouter, HTTPException
 from starlette.responses import JSONResponse
+from redis_cache.pipelines import invalidate_pipelines
+from mage_client.files import invalidate_file_tree
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.delete("/mage/block/delete", tags=["BLOCKS DELETE"])
 async def delete_block(block: DeleteBlock):
-    if token.check_token_expired():
-        token.update_token()
-
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if block.block_name == "" and block.pipeline_name == "":
         raise HTTPException(status_code=400, detail="Block should not be empty!")
 
-    response = requests.delete(f'{os.getenv("base_url")}/api/pipelines/{block.pipeline_name}/'
-                               f'blocks/{block.block_name}?block_type={block.block_type}&'
-                               f'api_key={os.getenv("API_KEY")}&force={block.force}')
+    response = await mage_client.request("DELETE", f'{os.getenv("base_url")}/api/pipelines/{block.pipeline_name}/'
+                                         f'blocks/{block.block_name}?block_type={block.block_type}&'
+                                         f'api_key={os.getenv("API_KEY")}&force={block.force}')
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    invalidate_pipelines(block.pipeline_name)
+    invalidate_file_tree()
+
     return JSONResponse(status_code=200, content="Block Deleted!")
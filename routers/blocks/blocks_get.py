@@ -1,21 +1,18 @@
 import os
 import re
 import json
-import requests
-from dependencies import Token
-from fastapi import APIRouter, HTTPException
+import mage_client.client as mage_client
+from dependencies import token
+from fastapi import APIRouter, HTTPException, Request
 from starlette.responses import JSONResponse
+from utils.etag import compute_etag, etag_response
+from redis_cache.cache import get_stale_while_revalidate
 
 router = APIRouter()
 
-token = Token()
 
-
-def get_template(name: str):
-    if token.check_token_expired():
-        token.update_token()
-
-    if token.token == "":
+async def get_template(name: str):
+    if await token.get_token() == "":
         return None
 
     url = f'{os.getenv("BASE_URL")}/api/custom_templates/{name}?object_type=blocks&api_key={os.getenv("API_KEY")}'
@@ -25,7 +22,7 @@ def get_template(name: str):
         "Authorization": f"Bearer {token.token}"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return None
@@ -51,29 +48,36 @@ def get_template(name: str):
 
 
 @router.get("/mage/block/model", tags=["BLOCKS GET"])
-async def block_model(block_name: str):
-    returns = get_template(block_name)
+async def block_model(request: Request, block_name: str):
+    async def compute() -> dict:
+        template = await get_template(block_name)
+
+        if template is None:
+            raise HTTPException(500, detail="Block model could not be loaded!")
 
-    if returns is None:
-        raise HTTPException(500, detail="Block model could not be loaded!")
+        return {
+            "etag": compute_etag(template),
+            "template": template
+        }
+
+    entry = await get_stale_while_revalidate(f"template:{block_name}", compute,
+                                             fresh_seconds=int(os.getenv("TEMPLATES_CACHE_TTL", "300")),
+                                             stale_seconds=int(os.getenv("TEMPLATES_CACHE_STALE_TTL", "3600")))
 
-    return JSONResponse(content=returns, status_code=200)
+    return etag_response(request, entry["template"], etag=entry["etag"])
 
 
 @router.get("/mage/block/read", tags=["BLOCKS GET"])
 async def read_block(block_name: str, pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if block_name != "" and pipeline_name != "":
         headers = {
             "Authorization": f"Bearer {token.token}"
         }
-        response = requests.get(f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/blocks/{block_name}?api_key='
-                                f'{os.getenv("API_KEY")}', headers=headers)
+        response = await mage_client.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/blocks/{block_name}?api_key='
+                                             f'{os.getenv("API_KEY")}', headers=headers)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
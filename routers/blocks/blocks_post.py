@@ -1,15 +1,16 @@
 import os
 import json
-import requests
+import mage_client.client as mage_client
 from typing import Annotated
-from dependencies import Token
+from dependencies import token
 from starlette.responses import JSONResponse
+from redis_cache.pipelines import invalidate_pipelines
+from mage_client.files import invalidate_file_tree
+from redis_cache.cache import delete_entries
 from fastapi import APIRouter, Form, UploadFile, HTTPException
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.post("/mage/block/create", tags=["BLOCKS POST"])
 async def block_create(block_name: Annotated[str, Form()], 
@@ -22,10 +23,7 @@ async def block_create(block_name: Annotated[str, Form()],
                        file: UploadFile
                        ):
 
-    if token.check_token_expired():
-        token.update_token()
-
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     file_data = file.file.read().decode("utf-8")
@@ -52,12 +50,15 @@ async def block_create(block_name: Annotated[str, Form()],
         "api-key": os.getenv("API_KEY")
     }
 
-    response = requests.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/blocks?'
-                                            f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
+    response = await mage_client.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/blocks?'
+                                         f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    invalidate_pipelines(pipeline_name)
+    invalidate_file_tree()
+
     return JSONResponse(status_code=200, content="Block Created!")
 
 
@@ -68,10 +69,7 @@ async def create_template(block_type: Annotated[str, Form()],
                           description: Annotated[str, Form()],
                           user_id: Annotated[str, Form()],
                           code: UploadFile):
-    if token.check_token_expired():
-        token.update_token()
-
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if block_type not in ["data_loader", "transformer", "data_exporter", "sensor"]:
@@ -99,7 +97,7 @@ async def create_template(block_type: Annotated[str, Form()],
         "Content-Type": "application/json"
     }
 
-    response = requests.request("POST", url, data=data, headers=headers)
+    response = await mage_client.request("POST", url, content=data, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -129,9 +127,11 @@ async def create_template(block_type: Annotated[str, Form()],
 
     data = json.dumps(data).replace("\\\\", "\\")
 
-    response = requests.request("PUT", url, data=data, headers=headers)
+    response = await mage_client.request("PUT", url, content=data, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    delete_entries("templates", f"template:{name}")
+
     return JSONResponse(f"Template {name} created successfully!", status_code=200)
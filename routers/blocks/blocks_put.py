@@ -1,17 +1,16 @@
 import os
 import json
-import requests
+import mage_client.client as mage_client
 import tempfile
 import subprocess
 from typing import Annotated
-from dependencies import Token
+from dependencies import token
 from starlette.responses import JSONResponse
+from redis_cache.pipelines import invalidate_block
 from fastapi import APIRouter, HTTPException, Form, UploadFile
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.put("/mage/block/update", tags=["BLOCKS PUT"])
 async def update_block(block_name: Annotated[str, Form()],
@@ -40,10 +39,7 @@ async def update_block(block_name: Annotated[str, Form()],
     except Exception:
         raise HTTPException(detail="Could not proceed further, python code is incorrectly formatted!", status_code=500)
 
-    if token.check_token_expired():
-        token.update_token()
-
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     block_type = block_type.replace("\n", "")
@@ -72,9 +68,11 @@ async def update_block(block_name: Annotated[str, Form()],
 
     data = json.dumps(data)
 
-    response = requests.request("PUT", url=url, headers=headers, data=data)
+    response = await mage_client.request("PUT", url=url, headers=headers, content=data)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    invalidate_block(block_name)
+
     return JSONResponse(status_code=200, content=f"Block {block_name} created successfully!")
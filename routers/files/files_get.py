@@ -1,23 +1,22 @@
 import datetime
 import json
 import os
-import requests
+import asyncio
+import mage_client.client as mage_client
 from io import BytesIO
-from dependencies import Token
+from dependencies import token
 from fastapi import APIRouter, HTTPException
-from starlette.responses import Response, JSONResponse
+from starlette.responses import Response, JSONResponse, StreamingResponse
+from mage_client.files import get_file_tree
+from redis_cache.cache import get_entries, set_entry
 
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.get("/mage/file/download", tags=["FILES GET"])
 async def download(file_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -28,7 +27,7 @@ async def download(file_name: str):
 
     url = f'{os.getenv("BASE_URL")}/api/file_contents/objects%2F{file_name}?api_key={os.getenv("API_KEY")}'
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code not in [200, 304]:
         raise HTTPException(status_code=500, detail="Could not retrieve the file contents!")
@@ -44,9 +43,7 @@ async def download(file_name: str):
 
 @router.get("/mage/file/download/plain", tags=["FILES GET"])
 async def download(file_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -57,7 +54,7 @@ async def download(file_name: str):
 
     url = f'{os.getenv("BASE_URL")}/api/file_contents/files%2F{file_name}?api_key={os.getenv("API_KEY")}'
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code not in [200, 304]:
         raise HTTPException(status_code=500, detail="Could not retrieve the file contents!")
@@ -69,9 +66,7 @@ async def download(file_name: str):
 
 @router.get("/mage/file/figures", tags=["FILES GET"])
 async def figures(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -80,42 +75,53 @@ async def figures(pipeline_name: str):
         'X-API-KEY': os.getenv("API_KEY")
     }
 
-    url = f'{os.getenv("BASE_URL")}/api/files?include_pipeline_count=true&api_key={os.getenv("API_KEY")}'
-
-    response = requests.request("GET", url, headers=headers)
+    tree = await get_file_tree(token.token)
 
-    if response.status_code not in [200, 304] or response.json().get("error"):
+    if tree is None:
         raise HTTPException(status_code=500, detail="Could not get the Mage folder structure!")
 
-    files = response.json().get("files", [])
-
-    images = []
-    for file in files[0]["children"]:
-        if file["name"] == "figures":
-            for child in file["children"]:
-                if child["name"] == pipeline_name:
-                    for figure in child["children"]:
-                        url = f'{os.getenv("BASE_URL")}/api/file_contents/figures%2F{pipeline_name}%2F{figure["name"]}?api_key={os.getenv("API_KEY")}'
-
-                        response = requests.request("GET", url, headers=headers)
-
-                        if response.status_code not in [200, 304]:
-                            continue
-
-                        content = response.json()["file_content"]["content"]
-                        images.append({
-                            "filename": figure["name"],
-                            "content": content
-                        })
-
-    return images
+    semaphore = asyncio.Semaphore(int(os.getenv("FIGURES_CONCURRENCY", "10")))
+
+    async def fetch_figure(name: str) -> dict | None:
+        url = f'{os.getenv("BASE_URL")}/api/file_contents/figures%2F{pipeline_name}%2F{name}?api_key={os.getenv("API_KEY")}'
+
+        try:
+            async with semaphore:
+                response = await mage_client.request("GET", url, headers=headers)
+
+            if response.status_code not in [200, 304]:
+                return None
+
+            return {
+                "filename": name,
+                "content": response.json()["file_content"]["content"]
+            }
+        except Exception as e:
+            # A failed figure is reported on its own line instead of ending the stream
+            return {
+                "filename": name,
+                "error": str(e)
+            }
+
+    async def stream_figures():
+        tasks = [asyncio.create_task(fetch_figure(figure["name"])) for figure in tree.children(f"figures/{pipeline_name}")]
+        try:
+            # One figure per line in the order they finish, so only the figures being downloaded are kept in memory
+            for next_figure in asyncio.as_completed(tasks):
+                image = await next_figure
+                if image is not None:
+                    yield json.dumps(image) + "\n"
+        finally:
+            # The client went away, the remaining downloads are not needed anymore
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_figures(), media_type="application/x-ndjson")
 
 
 @router.get("/mage/file/telemetry", tags=["FILES GET"])
 async def telemetry(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -124,57 +130,79 @@ async def telemetry(pipeline_name: str):
         'X-API-KEY': os.getenv("API_KEY")
     }
 
-    url = f'{os.getenv("BASE_URL")}/api/files?include_pipeline_count=true&api_key={os.getenv("API_KEY")}'
-
-    response = requests.request("GET", url, headers=headers)
+    tree = await get_file_tree(token.token)
 
-    if response.status_code not in [200, 304] or response.json().get("error"):
+    if tree is None:
         raise HTTPException(status_code=500, detail="Could not get the Mage folder structure!")
 
-    files = response.json().get("files", [])
+    blocks = [block for block in tree.children(f"telemetry/{pipeline_name}") if "json" in block["name"]]
+
+    # Unchanged telemetry files are served from the cache instead of being downloaded again
+    cached = get_entries([telemetry_key(pipeline_name, block["name"]) for block in blocks])
+
+    semaphore = asyncio.Semaphore(int(os.getenv("TELEMETRY_CONCURRENCY", "10")))
+
+    async def fetch_telemetry(block: dict) -> tuple[str, dict] | None:
+        key = telemetry_key(pipeline_name, block["name"])
+        modified_timestamp = block.get("modified_timestamp")
+
+        entry = cached.get(key, (None, None))[0]
+        if entry is not None and modified_timestamp is not None and entry["modified_timestamp"] == modified_timestamp:
+            return entry["id"], entry["telemetry"]
+
+        url = f'{os.getenv("BASE_URL")}/api/file_contents/telemetry%2F{pipeline_name}%2F{block["name"]}?api_key={os.getenv("API_KEY")}'
+
+        async with semaphore:
+            response = await mage_client.request("GET", url, headers=headers)
+
+        if response.status_code not in [200, 304]:
+            return None
+
+        content = response.json()["file_content"]["content"]
+        json_content = json.loads(content)
+        metrics = json_content['metrics']
+        block_telemetry = {
+            "Runtime (s)": float(f"{metrics['runtime']['sum']:.2f}"),
+            "CPU Utilization (%)": float(f"{metrics['cpu_util']['sum']:.2f}"),
+            "Network Write (B)": metrics['net_write']['sum'],
+            "Network Read (B)": metrics['net_read']['sum'],
+            "DRAM Memory Usage (B)": metrics['dram_mem']['sum'],
+            "Disk Write (B)": metrics['disk_write']['sum'],
+            "Disk Read (B)": metrics['disk_read']['sum'],
+            "Last Execution Date": json_content['metadata']['last_execution_dt']
+        }
+
+        if modified_timestamp is not None:
+            set_entry(key, {
+                "modified_timestamp": modified_timestamp,
+                "id": json_content["id"],
+                "telemetry": block_telemetry
+            }, int(os.getenv("TELEMETRY_CACHE_TTL", "86400")))
+
+        return json_content["id"], block_telemetry
 
     telemetry_per_block = {}
-    for file in files[0]["children"]:
-        if file["name"] == "telemetry":
-            for child in file["children"]:
-                if child["name"] == pipeline_name:
-                    for block in child["children"]:
-                        if "json" in block["name"]:
-                            url = f'{os.getenv("BASE_URL")}/api/file_contents/telemetry%2F{pipeline_name}%2F{block["name"]}?api_key={os.getenv("API_KEY")}'
-
-                            response = requests.request("GET", url, headers=headers)
-
-                            if response.status_code not in [200, 304]:
-                                continue
-
-                            content = response.json()["file_content"]["content"]
-                            json_content = json.loads(content)
-                            metrics = json_content['metrics']
-                            telemetry_per_block[json_content["id"]] = {
-                                "Runtime (s)": float(f"{metrics['runtime']['sum']:.2f}"),
-                                "CPU Utilization (%)": float(f"{metrics['cpu_util']['sum']:.2f}"),
-                                "Network Write (B)": metrics['net_write']['sum'],
-                                "Network Read (B)": metrics['net_read']['sum'],
-                                "DRAM Memory Usage (B)": metrics['dram_mem']['sum'],
-                                "Disk Write (B)": metrics['disk_write']['sum'],
-                                "Disk Read (B)": metrics['disk_read']['sum'],
-                                "Last Execution Date": json_content['metadata']['last_execution_dt']
-                            }
-
-    keys = list(telemetry_per_block.keys())
-    failed_keys = [x[7:] for x in keys if "failed_" in x]
-    normal_keys = [x for x in keys if "failed_" not in x]
-    for f in failed_keys:
-        for n in normal_keys:
-            if f == n:
-                f_datatime = datetime.datetime.strptime(telemetry_per_block[f"failed_{f}"]["Last Execution Date"], "%Y-%m-%dT%H:%M:%S.%f")
-                n_datatime = datetime.datetime.strptime(telemetry_per_block[n]["Last Execution Date"],
-                                                        "%Y-%m-%dT%H:%M:%S.%f")
-
-                if f_datatime > n_datatime:
-                    del telemetry_per_block[n]
-                else:
-                    del telemetry_per_block[f"failed_{f}"]
+    for result in await asyncio.gather(*[fetch_telemetry(block) for block in blocks]):
+        if result is not None:
+            telemetry_per_block[result[0]] = result[1]
+
+    # Keep only the latest execution of a block, either the failed or the successful one
+    for failed_key in [x for x in telemetry_per_block if x.startswith("failed_")]:
+        normal_key = failed_key[7:]
+        if normal_key not in telemetry_per_block:
+            continue
+
+        f_datatime = datetime.datetime.strptime(telemetry_per_block[failed_key]["Last Execution Date"], "%Y-%m-%dT%H:%M:%S.%f")
+        n_datatime = datetime.datetime.strptime(telemetry_per_block[normal_key]["Last Execution Date"],
+                                                "%Y-%m-%dT%H:%M:%S.%f")
+
+        if f_datatime > n_datatime:
+            del telemetry_per_block[normal_key]
+        else:
+            del telemetry_per_block[failed_key]
 
     return JSONResponse(status_code=200, content=telemetry_per_block)
 
+
+def telemetry_key(pipeline_name: str, file_name: str) -> str:
+    return f"telemetry:{pipeline_name}:{file_name}"
@@ -1,23 +1,19 @@
 import os
 import io
-import httpx
-import requests
-from dependencies import Token
+import mage_client.client as mage_client
+from dependencies import token
 from utils.models import FileCreate
+from mage_client.files import invalidate_file_tree
 from fastapi import APIRouter, HTTPException
 from starlette.responses import JSONResponse
 
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.post("/mage/files/create", tags=["FILES POST"])
 async def create_file(content: FileCreate):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -41,11 +37,13 @@ async def create_file(content: FileCreate):
             }
         }
 
-        response = requests.request("POST", url, json=body, headers=headers)
+        response = await mage_client.request("POST", url, json=body, headers=headers)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=f"Error creating the folder {content.name}!")
 
+        invalidate_file_tree()
+
         return JSONResponse("Folder created successfully!")
     elif content.type == "file":
         if content.content is None:
@@ -69,10 +67,11 @@ async def create_file(content: FileCreate):
             ),
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, files=files)
+        response = await mage_client.request("POST", url, headers=headers, files=files)
 
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail="Error encountered when importing the file!")
 
+        invalidate_file_tree()
+
         return JSONResponse(status_code=200, content="File imported sucessfully!")
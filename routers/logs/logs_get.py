@@ -1,23 +1,23 @@
 import os
 import json
-from json import JSONDecodeError
-
-import requests
-from dependencies import Token
-from collections import defaultdict
-from fastapi import APIRouter, HTTPException
-from starlette.responses import JSONResponse
+import asyncio
+import mage_client.client as mage_client
+from typing import Optional
+from dependencies import token
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import JSONResponse, StreamingResponse
+from utils.log_tail import get_block_log_tail
+from utils.log_parser import parse_line, last_line
+from utils.usage_series import USAGE_LABELS, UsageSeries, parse_usage_series
+from redis_cache.cache import get_entries, set_entry
+from utils.log_stream import get_poller
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.get("/mage/log/pipeline/{pipeline_name}", tags=["LOGS GET"])
 async def pipeline_logs(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/logs?&api_key={os.getenv("API_KEY")}'
@@ -26,93 +26,191 @@ async def pipeline_logs(pipeline_name: str):
         "Authorization": f"Bearer {token.token}"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=response.status_code, detail=response.json().get("error")["exception"])
 
-    grouped_by_name = defaultdict(list)
-
     scheduler_logs = [scheduler_log for scheduler_log in response.json()["logs"][0]["pipeline_run_logs"] if scheduler_log["name"] == "scheduler.log"]
 
-    for log in scheduler_logs:
-        grouped_by_name[log["name"]].append(log)
+    if len(scheduler_logs) == 0:
+        raise HTTPException(status_code=404, detail=f"There are no scheduler logs for {pipeline_name}!")
+
+    latest_log = max(scheduler_logs, key=lambda x: x["modified_timestamp"])
 
-    latest_logs_by_name = [max(logs, key=lambda x: x["modified_timestamp"]) for name, logs in
-                           grouped_by_name.items()][0]
+    # The usage is the last line of the scheduler log, only that line is decoded
+    usage = parse_line(last_line(latest_log["content"]))
+    if usage is None:
+        raise HTTPException(status_code=500, detail="Could not read the usage from the scheduler log!")
 
-    usage = json.loads(latest_logs_by_name["content"].split('\n')[-2][20:])
     usage["cpu"] = float(f"{usage['cpu'] * 100:.2f}")
     usage["cpu_usage"] = float(f"{usage['cpu_usage'] * 100:.2f}")
     usage["memory_usage"] = float(f"{usage['memory_usage'] * 100:.2f}")
 
-    key_mapping = {
-        'cpu': 'CPU Utilization (%)',
-        'cpu_total': 'Total CPU Cores',
-        'cpu_usage': 'CPU Usage Ratio (%)',
-        'memory': 'Memory Used (MB)',
-        'memory_total': 'Total Memory (MB)',
-        'memory_usage': 'Memory Usage Ratio (%)'
+    returns = {USAGE_LABELS[key]: value for i, (key, value) in enumerate(usage.items()) if i < 6}
+
+    return JSONResponse(status_code=200, content=returns)
+
+
+@router.get("/mage/log/usage/{pipeline_name}", tags=["LOGS GET"])
+async def pipeline_usage(pipeline_name: str, points: int = 200):
+    if await token.get_token() == "":
+        raise HTTPException(status_code=500, detail="Could not get the token!")
+
+    url = f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/logs?&api_key={os.getenv("API_KEY")}'
+
+    headers = {
+        "Authorization": f"Bearer {token.token}"
     }
 
-    returns = {key_mapping[key]: value for i, (key, value) in enumerate(usage.items()) if i < 6}
+    response = await mage_client.request("GET", url, headers=headers)
 
-    return JSONResponse(status_code=200, content=returns)
+    if response.status_code != 200 or response.json().get("error") is not None:
+        raise HTTPException(status_code=response.status_code, detail=response.json().get("error")["exception"])
+
+    scheduler_logs = sorted([scheduler_log for scheduler_log in response.json()["logs"][0]["pipeline_run_logs"]
+                             if scheduler_log["name"] == "scheduler.log"], key=lambda x: x["modified_timestamp"])
+
+    # Every run has its own scheduler log, the series of a log that did not change since it was parsed is reused.
+    # Without a path every log is named scheduler.log, so such logs are parsed each time instead of being cached
+    cached = get_entries([usage_key(pipeline_name, log["path"]) for log in scheduler_logs if log.get("path")])
+
+    runs = []
+    for log in scheduler_logs:
+        file = log.get("path", log["name"])
+        key = usage_key(pipeline_name, log["path"]) if log.get("path") else None
+
+        entry = cached.get(key, (None, None))[0] if key is not None else None
+        if entry is not None and entry["modified_timestamp"] == log["modified_timestamp"]:
+            series = UsageSeries.from_dict(entry["series"])
+        else:
+            series = parse_usage_series(log["content"])
+            if key is not None:
+                set_entry(key, {
+                    "modified_timestamp": log["modified_timestamp"],
+                    "series": series.to_dict()
+                }, int(os.getenv("USAGE_CACHE_TTL", "86400")))
+
+        runs.append({
+            "file": file,
+            "modified_timestamp": log["modified_timestamp"],
+            "samples": len(series),
+            "series": series.downsample(points).to_dict()
+        })
+
+    return JSONResponse(status_code=200, content={"labels": USAGE_LABELS, "runs": runs})
 
 
 @router.get("/mage/log/pipeline/{pipeline_name}/{block_name}", tags=["LOGS GET"])
 async def block_logs(pipeline_name: str, block_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
+        raise HTTPException(status_code=500, detail="Could not get the token!")
+
+    log = await latest_block_log(pipeline_name, block_name)
+
+    return JSONResponse(status_code=200, content=get_block_log_tail(pipeline_name, block_name, log).entries)
+
+
+@router.get("/mage/log/pipeline/{pipeline_name}/{block_name}/tail", tags=["LOGS GET"])
+async def block_logs_tail(pipeline_name: str,
+                          block_name: str,
+                          file: Optional[str] = None,
+                          offset: int = 0):
+    if await token.get_token() == "":
+        raise HTTPException(status_code=500, detail="Could not get the token!")
+
+    log = await latest_block_log(pipeline_name, block_name)
+    tail = get_block_log_tail(pipeline_name, block_name, log)
+
+    # A cursor from another log file belongs to an older run and one past the end to a replaced log,
+    # in both cases the log is sent again from the beginning
+    reset = (file is not None and file != tail.file) or offset > len(tail.entries)
+    if reset or offset < 0:
+        offset = 0
+
+    return JSONResponse(status_code=200, content={
+        "cursor": {
+            "file": tail.file,
+            "modified_timestamp": tail.modified_timestamp,
+            "offset": len(tail.entries)
+        },
+        "reset": reset,
+        "lines": tail.entries[offset:]
+    })
+
+
+@router.get("/mage/log/stream/{pipeline_name}/{block_name}", tags=["LOGS GET"])
+async def block_logs_stream(request: Request,
+                            pipeline_name: str,
+                            block_name: str,
+                            file: Optional[str] = None,
+                            offset: int = 0):
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
+    # Fails right away for a pipeline or a block that does not exist, instead of opening a stream that never sends anything
+    await latest_block_log(pipeline_name, block_name)
+
+    # Every client watching the pipeline shares the same poller, which downloads the logs once per interval
+    poller = get_poller(pipeline_name, fetch_block_logs)
+    subscriber = poller.subscribe(block_name, file, offset)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Comment line that keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if "error" in event:
+                    # The poller gave up on the pipeline, the client is told why and the stream is closed
+                    yield f"event: error\ndata: {json.dumps(event)}\n\n"
+                    return
+
+                yield f"event: logs\ndata: {json.dumps(event)}\n\n"
+        finally:
+            poller.unsubscribe(block_name, subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def fetch_block_logs(pipeline_name: str) -> dict[str, dict]:
+    """
+    Returns the latest log of every block of the pipeline, by block name.
+    :param pipeline_name: The name of the pipeline.
+    """
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}/logs?&api_key={os.getenv("API_KEY")}'
 
+    # Also called from the log pollers, outside of a request that already checked the token
     headers = {
-        "Authorization": f"Bearer {token.token}"
+        "Authorization": f"Bearer {await token.get_token()}"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=response.status_code, detail=response.json().get("error")["exception"])
 
-    grouped_by_name = defaultdict(list)
+    latest_logs = {}
+    for log in response.json()["logs"][0]["block_run_logs"]:
+        block_name = log["name"].removesuffix(".log")
+        if block_name not in latest_logs or log["modified_timestamp"] > latest_logs[block_name]["modified_timestamp"]:
+            latest_logs[block_name] = log
 
-    block_logs = [block_logs for block_logs in response.json()["logs"][0]["block_run_logs"] if block_logs["name"] == f"{block_name}.log"]
+    return latest_logs
 
-    if len(block_logs) == 0:
-        raise HTTPException(status_code=500, detail="Block does not exists or it does not have any logs yet!")
 
-    for log in block_logs:
-        grouped_by_name[log["name"]].append(log)
+async def latest_block_log(pipeline_name: str, block_name: str) -> dict:
+    logs = await fetch_block_logs(pipeline_name)
 
-    latest_logs_by_name = [max(logs, key=lambda x: x["modified_timestamp"]) for name, logs in
-                           grouped_by_name.items()][0]
+    if block_name not in logs:
+        raise HTTPException(status_code=500, detail="Block does not exists or it does not have any logs yet!")
 
-    contents = []
-    for content in latest_logs_by_name["content"].split("\n"):
-        try:
-            contents.append(json.loads(content[20:]))
-        except JSONDecodeError:
-            continue
-
-    returns = []
-    start = False
-    for content in contents:
-        if not start:
-            if content["message"] != "Start executing block with BlockExecutor.":
-                continue
-            else:
-                start = True
-        elif "-----" in content["message"]:
-            break
-        else:
-            returns.append({
-                "Log Level": content["level"],
-                "Timestamp": content["timestamp"],
-                "Message": content["message"],
-            })
+    return logs[block_name]
 
-    return JSONResponse(status_code=200, content=returns)
+
+def usage_key(pipeline_name: str, file: str) -> str:
+    return f"usage:{pipeline_name}:{file}"
@@ -1,21 +1,18 @@
 import os
-import requests
-import threading
-from queue import Queue
-from dependencies import Token
+import asyncio
+import mage_client.client as mage_client
+from dependencies import token
 from fastapi import APIRouter, HTTPException
 from starlette.responses import JSONResponse
+from redis_cache.pipelines import invalidate_pipelines
+from mage_client.files import invalidate_file_tree
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.delete("/mage/pipeline/delete", tags=["PIPELINES DELETE"])
 async def delete_pipeline(name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}/pipeline_schedules?api_key={os.getenv("API_KEY")}'
@@ -24,7 +21,7 @@ async def delete_pipeline(name: str):
         "Content-Type": "application/json"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=response.status_code, detail=response.json().get("error")["exception"])
@@ -35,42 +32,34 @@ async def delete_pipeline(name: str):
         "X-API-KEY": os.getenv("API_KEY")
     }
 
-    error_queue = Queue()
-
-    def delete_schedule(schedule_id: int, head: dict[str, str]) -> None:
-        resp = requests.request(
+    async def delete_schedule(schedule_id: int, head: dict[str, str]) -> bool:
+        resp = await mage_client.request(
             "DELETE",
             f'{os.getenv("BASE_URL")}/api/pipeline_schedules/{schedule_id}?api_key={os.getenv("API_KEY")}',
             headers=head
         )
 
-        if resp.status_code != 200 or resp.json().get("error") is not None:
-            error_queue.put(schedule_id)
+        return resp.status_code == 200 and resp.json().get("error") is None
 
     pipeline_schedules = response.json()["pipeline_schedules"] if len(
         response.json()["pipeline_schedules"]) > 0 else None
 
     if pipeline_schedules is not None:
-        threads = []
-
-        for schedule in pipeline_schedules:
-            thread = threading.Thread(target=delete_schedule, args=(schedule["id"], headers))
-            threads.append(thread)
-            thread.start()
+        results = await asyncio.gather(*[delete_schedule(schedule["id"], headers) for schedule in pipeline_schedules])
 
-        for thread in threads:
-            thread.join()
-
-        errors = error_queue.qsize()
+        errors = results.count(False)
 
         if errors > 0:
             raise HTTPException(status_code=500, detail=f"Could not delete all the triggers for pipeline {name}")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}'
 
-    response = requests.request("DELETE", url, headers=headers)
+    response = await mage_client.request("DELETE", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    invalidate_pipelines(name)
+    invalidate_file_tree()
+
     return JSONResponse(status_code=200, content="Pipeline deleted successfully!")
@@ -1,30 +1,30 @@
-import io
 import os
 import re
+import time
+import base64
 import yaml
 import json
-import zipfile
-import requests
+import asyncio
+import mage_client.client as mage_client
 import urllib.parse
 from typing import Optional
-from datetime import datetime
-from dependencies import Token
-from fastapi import APIRouter, HTTPException
+from dependencies import token
+from fastapi import APIRouter, HTTPException, Request
 from mage_to_cwl.mage_to_cwl import MageToCWL
-from utils.pipelines import parse_pipeline, parse_pipelines
+from utils.pipelines import parse_pipeline, parse_pipeline_run
+from mage_client.files import get_file_tree
+from utils.etag import compute_etag, combine_etags, etag_response
+from utils.zip_stream import stream_zip
 from starlette.responses import JSONResponse, StreamingResponse
-from redis_cache.cache import get_data_from_redis, is_data_stale, set_data_in_redis, update_timestamp
+from redis_cache.cache import get_stale_while_revalidate, get_or_compute, get_entries, set_entry
+from redis_cache.pipelines import PIPELINES_LIST_KEY, pipeline_key, get_cached_pipelines, index_pipelines
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.get("/mage/pipeline/triggers", tags=["PIPELINES GET"])
 async def pipeline_triggers(name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}/pipeline_schedules?api_key={os.getenv("API_KEY")}'
@@ -33,7 +33,7 @@ async def pipeline_triggers(name: str):
         "Content-Type": "application/json"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -48,9 +48,7 @@ async def pipeline_triggers(name: str):
 
 @router.get("/mage/pipeline/status/streaming", tags=["PIPELINES GET"])
 async def pipeline_streaming_status(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -60,7 +58,7 @@ async def pipeline_streaming_status(pipeline_name: str):
 
     url = f"{os.getenv('BASE_URL')}/api/pipeline_runs?pipeline_uuid={pipeline_name}&api_key={os.getenv('API_KEY')}"
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500,
@@ -71,9 +69,7 @@ async def pipeline_streaming_status(pipeline_name: str):
 
 @router.get("/mage/pipeline/status/batch", tags=["PIPELINES GET"])
 async def pipeline_batch_status(pipeline_id: int):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipeline_schedules/{pipeline_id}/pipeline_runs?api_key={os.getenv("API_KEY")}'
@@ -82,7 +78,7 @@ async def pipeline_batch_status(pipeline_id: int):
         'Authorization': f'Bearer {token.token}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -97,9 +93,7 @@ async def pipeline_batch_status(pipeline_id: int):
 
 @router.get("/mage/pipelines", tags=["PIPELINES GET"])
 async def pipelines(tag: Optional[str] = None):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     valid_tags = ["train", "data_preprocessing", "streaming"]
@@ -114,7 +108,7 @@ async def pipelines(tag: Optional[str] = None):
         'Authorization': f'Bearer {token.token}'
     }
 
-    response = requests.get(pipelines_url, headers=headers)
+    response = await mage_client.request("GET", pipelines_url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -133,94 +127,20 @@ async def pipelines(tag: Optional[str] = None):
 
 
 @router.get("/mage/pipelines/specific", tags=["PIPELINES GET"])
-async def specific_pipelines(contains: str, changed: bool = False):
-    cache_key = f"pipelines:{contains}"
-
-    if changed:
-        if token.check_token_expired():
-            token.update_token()
-        if token.token == "":
-            return JSONResponse(status_code=500, content="Could not get the token!")
-
-        url = f'{os.getenv("BASE_URL")}/api/pipelines?api_key={os.getenv("API_KEY")}'
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token.token}"
-        }
-
-        response = requests.request("GET", url, headers=headers)
-
-        if response.status_code != 200 or response.json().get("error") is not None:
-            raise HTTPException(status_code=500,
-                                detail=response.json().get("error")["exception"])
-
-        if len(response.json().get("pipelines")) == 0:
-            return JSONResponse(status_code=200, content=[])
-
-        pipes = []
-        for pipeline in response.json().get("pipelines"):
-            resp = requests.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline.get("uuid")}?'
-                                           f'api_key={os.getenv("API_KEY")}', headers=headers)
-
-            if resp.status_code == 200:
-                if resp.json().get("error") is None:
-                    pipes.append(resp.json().get("pipeline"))
-
-        pipes = parse_pipelines(pipes, contains)
-
-        set_data_in_redis(cache_key, json.dumps(pipes), expire_time_seconds=60)
-
-        update_timestamp(cache_key)
-
-        return JSONResponse(status_code=200, content=pipes)
-
-    cached_data = get_data_from_redis(cache_key)
-    if cached_data and not is_data_stale(cache_key, expire_time_seconds=60):
-        return JSONResponse(status_code=200, content=json.loads(cached_data.decode()))
-
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+async def specific_pipelines(request: Request, contains: str, changed: bool = False):
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
-    url = f'{os.getenv("BASE_URL")}/api/pipelines?api_key={os.getenv("API_KEY")}'
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token.token}"
-    }
-
-    response = requests.request("GET", url, headers=headers)
-
-    if response.status_code != 200 or response.json().get("error") is not None:
-        raise HTTPException(status_code=500,
-                            detail=response.json().get("error")["exception"])
-
-    if len(response.json().get("pipelines")) == 0:
-        return JSONResponse(status_code=200, content=[])
-
-    pipes = []
-    for pipeline in response.json().get("pipelines"):
-        resp = requests.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline.get("uuid")}?'
-                                       f'api_key={os.getenv("API_KEY")}', headers=headers)
-
-        if resp.status_code == 200:
-            if resp.json().get("error") is None:
-                pipes.append(resp.json().get("pipeline"))
+    entries = await fetch_pipelines(contains, force=changed)
 
-    pipes = parse_pipelines(pipes, contains)
-
-    set_data_in_redis(cache_key, json.dumps(pipes), expire_time_seconds=60)
-
-    update_timestamp(cache_key)
-
-    return JSONResponse(status_code=200, content=pipes)
+    # The list ETag is built from the ETags stored with every pipeline entry, so the content is not hashed again
+    return etag_response(request, [entry["pipeline"] for entry in entries],
+                         etag=combine_etags([entry["etag"] for entry in entries]))
 
 
 @router.get("/mage/pipeline/read", tags=["PIPELINES GET"])
-async def read_pipeline(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+async def read_pipeline(request: Request, pipeline_name: str):
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if pipeline_name != "":
@@ -228,24 +148,22 @@ async def read_pipeline(pipeline_name: str):
             "Authorization": f"Bearer {token.token}"
         }
 
-        response = requests.get(f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}?api_key='
-                                f'{os.getenv("API_KEY")}', headers=headers)
+        response = await mage_client.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}?api_key='
+                                             f'{os.getenv("API_KEY")}', headers=headers)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
         result = parse_pipeline(response.json().get("pipeline"))
 
-        return JSONResponse(status_code=200, content=result)
+        return etag_response(request, result)
 
     raise HTTPException(status_code=400, detail="Pipeline name should not be empty!")
 
 
 @router.get("/mage/pipeline/read/full", tags=["PIPELINES GET"])
 async def read_full_pipeline(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if pipeline_name != "":
@@ -253,8 +171,8 @@ async def read_full_pipeline(pipeline_name: str):
             "Authorization": f"Bearer {token.token}"
         }
 
-        response = requests.get(f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}?api_key='
-                                f'{os.getenv("API_KEY")}', headers=headers)
+        response = await mage_client.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}?api_key='
+                                             f'{os.getenv("API_KEY")}', headers=headers)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -266,9 +184,7 @@ async def read_full_pipeline(pipeline_name: str):
 
 @router.get("/mage/pipeline/read/predict/full", tags=["PIPELINES GET"])
 async def read_full_pipeline(model_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if model_name != "":
@@ -278,8 +194,8 @@ async def read_full_pipeline(model_name: str):
             "X-API-KEY": os.getenv("API_KEY")
         }
 
-        response = requests.get(f'{os.getenv("BASE_URL")}/api/pipelines?api_key={os.getenv("API_KEY")}',
-                                headers=headers)
+        response = await mage_client.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines?api_key={os.getenv("API_KEY")}',
+                                             headers=headers)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -299,62 +215,37 @@ async def read_full_pipeline(model_name: str):
 
 
 @router.get("/mage/pipeline/history", tags=["PIPELINES GET"])
-async def pipeline_history(pipeline_name: str, limit: int = 30):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+async def pipeline_history(pipeline_name: str, limit: int = 30, cursor: Optional[str] = None):
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
-    headers = {
-        "Authorization": f"Bearer {token.token}",
-        "Content-Type": "application/json"
-    }
+    offset, before = decode_history_cursor(cursor) if cursor is not None else (0, None)
 
-    url = f'{os.getenv("BASE_URL")}/api/pipeline_runs?_limit={limit}&_offset=0&pipeline_uuid={pipeline_name}&disable_retries_grouping=true&api_key={os.getenv("API_KEY")}'
+    key = history_page_key(pipeline_name, before, limit)
 
-    response = requests.request("GET", url, headers=headers)
+    if before is None:
+        # The first page holds the new runs and the ones that are still going, so it is only kept for a few seconds,
+        # enough for the clients polling it to share the same request to Mage
+        page = await get_or_compute(key, lambda: fetch_history_page(pipeline_name, limit, offset, before),
+                                    int(os.getenv("HISTORY_FIRST_PAGE_TTL", "5")))
+        return history_response(page["runs"], page["next_cursor"])
 
-    if response.status_code != 200 or response.json().get("error") is not None:
-        raise HTTPException(detail=response.json().get("error")["exception"], status_code=500)
+    # The runs after the cursor are older than every run that is still going, so a page of finished runs never changes
+    page = get_entries([key]).get(key, (None, None))[0]
+    if page is not None:
+        return history_response(page["runs"], page["next_cursor"])
 
-    returns = []
+    page = await fetch_history_page(pipeline_name, limit, offset, before)
 
-    for entry in response.json()["pipeline_runs"]:
-        failed_index = None
-        for i, block_run in enumerate(entry["block_runs"]):
-            if block_run["status"] == "failed":
-                failed_index = i
-                break
+    if page["cacheable"]:
+        set_entry(key, page, int(os.getenv("HISTORY_CACHE_TTL", "86400")))
 
-        return_data = {}
-        if failed_index is None:
-            return_data["status"] = entry["status"]
-            return_data["variables"] = entry["variables"]
-            return_data["running_date"] = datetime.strftime(
-                datetime.strptime(entry["execution_date"], "%Y-%m-%d %H:%M:%S.%f"), "%Y-%m-%d %H:%M")
-            return_data["last_completed_block"] = entry["block_runs"][-1]["block_uuid"]
-            return_data["last_failed_block"] = "-"
-            return_data["error_message"] = "-"
-        else:
-            return_data["status"] = entry["status"]
-            return_data["variables"] = entry["variables"]
-            return_data["running_date"] = datetime.strftime(
-                datetime.strptime(entry["execution_date"], "%Y-%m-%d %H:%M:%S.%f"), "%Y-%m-%d %H:%M")
-            return_data["last_completed_block"] = entry["block_runs"][failed_index - 1]["block_uuid"]
-            return_data["last_failed_block"] = entry["block_runs"][failed_index]["block_uuid"]
-            return_data["error_message"] = entry["block_runs"][failed_index]["metrics"]["error"]["error"] if len(
-                entry["block_runs"][failed_index]["metrics"].keys()) else "-"
-
-        returns.append(return_data)
-
-    return JSONResponse(returns, status_code=200)
+    return history_response(page["runs"], page["next_cursor"])
 
 
 @router.get("/mage/pipeline/description", tags=["PIPELINES GET"])
-async def description(name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+async def description(request: Request, name: str):
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}?api_key={os.getenv("API_KEY")}'
@@ -364,35 +255,41 @@ async def description(name: str):
         "Authorization": f"Bearer {token.token}"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
-    return JSONResponse(status_code=200, content=response.json()["pipeline"]["description"])
+    return etag_response(request, response.json()["pipeline"]["description"])
 
 
 @router.get("/mage/pipeline/templates", tags=["PIPELINES GET"])
 async def templates(pipeline_type: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
-        raise HTTPException(status_code=500, detail="Could not get the token!")
+    async def compute() -> list[dict]:
+        if await token.get_token() == "":
+            raise HTTPException(status_code=500, detail="Could not get the token!")
 
-    url = f'{os.getenv("BASE_URL")}/api/custom_templates?object_type=blocks&api_key={os.getenv("API_KEY")}'
+        url = f'{os.getenv("BASE_URL")}/api/custom_templates?object_type=blocks&api_key={os.getenv("API_KEY")}'
 
-    headers = {
-        "Authorization": f"Bearer {token.token}",
-        "Content-Type": "application/json"
-    }
+        headers = {
+            "Authorization": f"Bearer {token.token}",
+            "Content-Type": "application/json"
+        }
 
-    response = requests.request("GET", url, headers=headers)
+        response = await mage_client.request("GET", url, headers=headers)
 
-    if response.status_code != 200 or response.json().get("error") is not None:
-        raise HTTPException(detail=response.json().get("error")["exception"], status_code=500)
+        if response.status_code != 200 or response.json().get("error") is not None:
+            raise HTTPException(detail=response.json().get("error")["exception"], status_code=500)
+
+        return [{
+            "block_type": entry["block_type"],
+            "template_uuid": entry["template_uuid"],
+            "description": entry["description"]
+        } for entry in response.json()["custom_templates"]]
 
-    body = response.json()["custom_templates"]
-    print(body)
+    body = await get_stale_while_revalidate("templates", compute,
+                                            fresh_seconds=int(os.getenv("TEMPLATES_CACHE_TTL", "300")),
+                                            stale_seconds=int(os.getenv("TEMPLATES_CACHE_STALE_TTL", "3600")))
 
     templates = []
     for entry in body:
@@ -410,76 +307,84 @@ async def templates(pipeline_type: str):
 
 @router.get("/mage/pipeline/export/cwl", tags=["PIPELINES GET"])
 async def export_pipeline_cwl(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
         "Authorization": f"Bearer {token.token}"
     }
 
-    response = requests.get(f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}?api_key='
-                            f'{os.getenv("API_KEY")}', headers=headers)
+    response = await mage_client.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{pipeline_name}?api_key='
+                                         f'{os.getenv("API_KEY")}', headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
-    repository_name = get_repo_name(local_token=token.token)
+    repository_name = await get_repo_name(local_token=token.token)
 
     blocks = response.json()["pipeline"]["blocks"]
-    blocks.sort(key=lambda x: (len(x['upstream_blocks']) == 0, len(x['downstream_blocks']) != 0))
-
-    sorted_data = [blocks[0]]
-
-    while len(sorted_data) < len(blocks):
-        last_uuid = sorted_data[-1]['uuid']
-        next_block = next((block for block in blocks if last_uuid in block['upstream_blocks']), None)
-        if next_block:
-            sorted_data.append(next_block)
-        else:
-            break
-
-    remaining_blocks = [block for block in blocks if block not in sorted_data]
-    sorted_data.extend(remaining_blocks)
 
-    sorted_data.reverse()
+    if len(blocks) == 0:
+        raise HTTPException(status_code=400, detail=f"Pipeline '{pipeline_name}' has no blocks!")
 
     download_utils = False
 
-    for block in sorted_data:
+    for block in blocks:
         if f"from {repository_name}" in block["content"] or f"import {repository_name}" in block["content"]:
             download_utils = True
             break
 
-    mtc = MageToCWL(sorted_data, pipeline_name, repository_name)
-    mtc.process()
-    zip_buffer = io.BytesIO()
+    try:
+        # The blocks are ordered by MageToCWL following their upstream and downstream blocks
+        mtc = MageToCWL(blocks, pipeline_name, repository_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for file_path, content in mtc.files.items():
-            if content is None:
-                zipf.writestr(file_path, '')
-            else:
-                zipf.writestr(file_path, content)
+    cache_ttl = int(os.getenv("CWL_CACHE_TTL", "86400"))
+
+    async def compute() -> dict:
+        # Only the blocks whose content, upstream block or repository changed are converted again
+        block_keys = [cwl_block_key(fingerprint) for fingerprint in mtc.block_fingerprints]
+        cached = get_entries(block_keys)
+        # The conversion is CPU bound, it runs on the process pool and its thread is the one that waits for it
+        await asyncio.to_thread(mtc.process, {fingerprint: cached[key][0] for fingerprint, key in zip(mtc.block_fingerprints, block_keys) if key in cached})
+
+        for fingerprint, converted in mtc.converted.items():
+            set_entry(cwl_block_key(fingerprint), converted, cache_ttl)
+
+        return mtc.files
+
+    generated_files = await get_or_compute(f"cwl_export:{mtc.fingerprint}", compute, cache_ttl)
+
+    utils_files = []
+    if download_utils:
+        utils_files = await get_folder("utils", local_token=token.token) or []
+
+    semaphore = asyncio.Semaphore(int(os.getenv("EXPORT_CONCURRENCY", "10")))
 
-        if download_utils:
-            files = get_folder("utils", local_token=token.token)
-            if files is not None:
-                for file_info in files:
-                    try:
-                        file_content = download_file(file_info["encoded_path"], token.token)
+    async def download(file_info: dict) -> bytes:
+        try:
+            async with semaphore:
+                return await download_file(file_info["encoded_path"], token.token)
+        except Exception as e:
+            print(f"Failed to download or add {file_info['full_path']} to zip: {str(e)}")
+            raise HTTPException(status_code=500,
+                                detail=f"Failed to download or add {file_info['full_path']} to zip!")
 
-                        zipf.writestr(pipeline_name + "/scripts/" + file_info["full_path"], file_content)
+    downloads = [(pipeline_name + "/scripts/" + file_info["full_path"], asyncio.create_task(download(file_info)))
+                 for file_info in utils_files]
 
-                    except Exception as e:
-                        print(f"Failed to download or add {file_info['full_path']} to zip: {str(e)}")
-                        raise HTTPException(status_code=500,
-                                            detail=f"Failed to download or add {file_info['full_path']} to zip!")
+    async def archive_entries():
+        try:
+            for file_path, content in generated_files.items():
+                yield file_path, content if content is not None else ''
 
-    zip_buffer.seek(0)
+            for file_path, task in downloads:
+                yield file_path, await task
+        finally:
+            cancel_downloads(downloads)
 
-    response = StreamingResponse(zip_buffer, media_type="application/x-zip-compressed")
+    response = StreamingResponse(stream_zip(archive_entries()), media_type="application/x-zip-compressed")
     response.headers["Content-Disposition"] = f"attachment; filename={pipeline_name}.zip"
 
     return response
@@ -487,56 +392,68 @@ async def export_pipeline_cwl(pipeline_name: str):
 
 @router.get("/mage/pipeline/export", tags=["PIPELINES GET"])
 async def export_pipeline(pipeline_name: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
-    pipeline_folder = get_folder(f"pipelines/{pipeline_name}", local_token=token.token)
+    pipeline_folder = await get_folder(f"pipelines/{pipeline_name}", local_token=token.token)
 
     if pipeline_folder is None:
         raise HTTPException(status_code=404, detail=f"Pipeline '{pipeline_name}' not found!")
 
-    file_contents = []
+    semaphore = asyncio.Semaphore(int(os.getenv("EXPORT_CONCURRENCY", "10")))
+
+    async def download(encoded_file_name: str) -> bytes:
+        async with semaphore:
+            return await download_file(encoded_file_name, token.token)
+
+    # Every file starts downloading right away, the archive is written in order as each of them is done
+    downloads = [(entry["full_path"], asyncio.create_task(download(urllib.parse.quote(f'pipelines/{entry["encoded_path"]}'))))
+                 for entry in pipeline_folder]
+
     readme = f"# {' '.join(pipeline_name.split('_')).title()} configuration \n- Add the folder called **{pipeline_name}** inside the **pipelines** folder in MageAI."
-    metadata = None
-    for entry in pipeline_folder:
-        file_content = download_file(urllib.parse.quote(f'pipelines/{entry["encoded_path"]}'), token.token)
-        if "metadata.yaml" in entry["encoded_path"]:
-            metadata = yaml.safe_load(file_content)
-
-        file_contents.append({"path": entry["full_path"], "content": file_content})
-
-    if metadata:
-        for block in metadata["blocks"]:
-            block_type = block["type"]
-            block_name = block["name"]
-            block_content = download_file(urllib.parse.quote(f'{block_type}s/{block_name}.py'), token.token)
-            file_contents.append({"path": f'{block_name}.py', "content": block_content})
-            readme += f"\n- Add file **{block_name}.py** to **{block_type}s** folder in MageAI."
-
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for file_info in file_contents:
-            zipf.writestr(file_info["path"], file_info["content"])
-        zipf.writestr("README.md", readme)
-
-    zip_buffer.seek(0)
-
-    response = StreamingResponse(zip_buffer, media_type="application/x-zip-compressed")
+
+    try:
+        metadata = None
+        for entry, (_, task) in zip(pipeline_folder, downloads):
+            if "metadata.yaml" in entry["encoded_path"]:
+                metadata = yaml.safe_load(await task)
+
+        if metadata:
+            for block in metadata["blocks"]:
+                block_type = block["type"]
+                block_name = block["name"]
+                downloads.append((f'{block_name}.py', asyncio.create_task(download(urllib.parse.quote(f'{block_type}s/{block_name}.py')))))
+                readme += f"\n- Add file **{block_name}.py** to **{block_type}s** folder in MageAI."
+    except HTTPException:
+        cancel_downloads(downloads)
+        raise
+    except Exception as e:
+        cancel_downloads(downloads)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def archive_entries():
+        try:
+            for path, task in downloads:
+                yield path, await task
+            yield "README.md", readme
+        finally:
+            # The client went away or a download failed, the remaining downloads are not needed anymore
+            cancel_downloads(downloads)
+
+    response = StreamingResponse(stream_zip(archive_entries()), media_type="application/x-zip-compressed")
     response.headers["Content-Disposition"] = f"attachment; filename={pipeline_name}.zip"
 
     return response
 
 
-def get_repo_name(local_token: str) -> str | None:
+async def get_repo_name(local_token: str) -> str | None:
     url = f'{os.getenv("BASE_URL")}/api/statuses?api_key={os.getenv("API_KEY")}'
 
     headers = {
         "Authorization": f"Bearer {local_token}"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code not in [200, 304] or response.json().get("error"):
         return
@@ -548,14 +465,14 @@ def get_repo_name(local_token: str) -> str | None:
     return
 
 
-def download_file(encoded_file_name: str, local_token: str):
+async def download_file(encoded_file_name: str, local_token: str):
     url = f'{os.getenv("BASE_URL")}/api/file_contents/{encoded_file_name}?api_key={os.getenv("API_KEY")}'
 
     headers = {
         "Authorization": f"Bearer {local_token}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code not in [200, 304]:
         raise ValueError(f"Could not retrieve the file contents for {encoded_file_name}!")
@@ -582,33 +499,203 @@ def parse_file_structure(node, current_path=""):
     return files
 
 
-def get_folder(folder_name: str, local_token: str):
-    url = f'{os.getenv("BASE_URL")}/api/files?include_pipeline_count=true&api_key={os.getenv("API_KEY")}'
+async def get_folder(folder_name: str, local_token: str):
+    tree = await get_file_tree(local_token)
+
+    if tree is None:
+        return None
+
+    folder = tree.get(folder_name)
+    if folder is None:
+        return None
 
+    file_names = parse_file_structure(folder)  # Will contain the encoded_path and full_path for the files in that specified folder
+
+    return file_names if file_names else None
+
+
+async def list_pipelines() -> list[dict]:
+    if await token.get_token() == "":
+        raise HTTPException(status_code=500, detail="Could not get the token!")
+
+    url = f'{os.getenv("BASE_URL")}/api/pipelines?api_key={os.getenv("API_KEY")}'
     headers = {
-        "Authorization": f"Bearer {local_token}"
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token.token}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
-    if response.status_code not in [200, 304] or response.json().get("error"):
-        return None
+    if response.status_code != 200 or response.json().get("error") is not None:
+        raise HTTPException(status_code=500,
+                            detail=response.json().get("error")["exception"])
 
-    i = 0
-    file_names = None  # Will contain the encoded_path and full_path for the files in that specified folder
-    folder_names = folder_name.split("/")  # Split the folder_name at "/" if there is a multilayer path
-    files_data = response.json().get("files", [])  # All the files in the root structure folder
-    current_path = files_data[0].get("children", [])  # The current children of the root structure folder
-
-    if current_path:
-        while i < len(folder_names) and current_path:
-            for file in current_path:
-                if file["name"] == folder_names[i]:
-                    if i == len(folder_names) - 1:
-                        file_names = parse_file_structure(file)
-                        break
-                    current_path = file.get("children", [])
-                    break
-            i += 1
+    return [{
+        "uuid": pipeline.get("uuid"),
+        "updated_at": pipeline.get("updated_at")
+    } for pipeline in response.json().get("pipelines")]
 
-    return file_names if file_names else None
+
+async def fetch_pipelines(contains: str, force: bool = False) -> list[dict]:
+    # The mutating endpoints invalidate the affected entries, so they can be kept fresh for longer
+    listing = await get_stale_while_revalidate(PIPELINES_LIST_KEY, list_pipelines,
+                                               fresh_seconds=int(os.getenv("PIPELINES_CACHE_TTL", "600")),
+                                               stale_seconds=int(os.getenv("PIPELINES_CACHE_STALE_TTL", "3600")),
+                                               force=force)
+
+    # Each pipeline is cached once, a query only looks up the ones matching contains
+    matching = [pipeline for pipeline in listing if contains in pipeline["uuid"]]
+    cached = get_cached_pipelines([pipeline["uuid"] for pipeline in matching])
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token.token}"
+    }
+
+    semaphore = asyncio.Semaphore(int(os.getenv("PIPELINES_CONCURRENCY", "10")))
+
+    async def fetch_pipeline(name: str, updated_at: str | None) -> dict | None:
+        def is_valid(entry: dict) -> bool:
+            if force or "etag" not in entry:
+                return False
+
+            # A pipeline without an update stamp can't be revalidated, so it is kept only for as long as the list is
+            if updated_at is None:
+                return time.time() - entry.get("cached_at", 0) <= int(os.getenv("PIPELINES_CACHE_TTL", "600"))
+
+            return entry["updated_at"] == updated_at
+
+        entry = cached.get(name)
+        if entry is not None and is_valid(entry):
+            return entry
+
+        async def compute() -> dict:
+            async with semaphore:
+                resp = await mage_client.request("GET", f'{os.getenv("BASE_URL")}/api/pipelines/{name}?'
+                                                 f'api_key={os.getenv("API_KEY")}', headers=headers)
+
+            if resp.status_code != 200 or resp.json().get("error") is not None:
+                raise ValueError(f"Could not retrieve the pipeline {name}!")
+
+            pipeline = parse_pipeline(resp.json().get("pipeline"))
+
+            return {
+                "updated_at": updated_at,
+                "cached_at": time.time(),
+                "etag": compute_etag(pipeline),
+                "pipeline": pipeline
+            }
+
+        try:
+            return await get_or_compute(pipeline_key(name), compute,
+                                        expire_time_seconds=int(os.getenv("PIPELINE_CACHE_TTL", "86400")),
+                                        is_valid=is_valid)
+        except ValueError:
+            return None
+
+    entries = await asyncio.gather(*[fetch_pipeline(pipeline["uuid"], pipeline["updated_at"]) for pipeline in matching])
+
+    index_pipelines(*[pipeline["uuid"] for pipeline, entry in zip(matching, entries) if entry is not None])
+
+    return [entry for entry in entries if entry is not None]
+
+
+def cwl_block_key(fingerprint: str) -> str:
+    return f"cwl_block:{fingerprint}"
+
+
+FINISHED_RUN_STATUSES = ("completed", "failed", "cancelled")
+
+
+def history_page_key(pipeline_name: str, before: tuple[str, int] | None, limit: int) -> str:
+    if before is None:
+        return f"history:{pipeline_name}:first:{limit}"
+    return f"history:{pipeline_name}:{before[0]}:{before[1]}:{limit}"
+
+
+def history_sort_key(pipeline_run: dict) -> tuple[str, int]:
+    # Mage lists the runs by execution date and then by id, newest first, so a backfilled or retried run can have
+    # a higher id than newer runs and the id alone can't tell where a page ends
+    return pipeline_run.get("execution_date") or "", pipeline_run["id"]
+
+
+def encode_history_cursor(offset: int, before: tuple[str, int]) -> str:
+    content = {"offset": offset, "execution_date": before[0], "id": before[1]}
+    return base64.urlsafe_b64encode(json.dumps(content).encode()).decode()
+
+
+def decode_history_cursor(cursor: str) -> tuple[int, tuple[str, int]]:
+    try:
+        content = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(content["offset"]), (str(content["execution_date"]), int(content["id"]))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="The history cursor is not valid!")
+
+
+async def fetch_history_page(pipeline_name: str, limit: int, offset: int, before: tuple[str, int] | None) -> dict:
+    """
+    Returns the limit runs that come after the cursor, with the cursor of the next page.
+    :param pipeline_name: The name of the pipeline.
+    :param limit: The number of runs in the page.
+    :param offset: Where the page started in the list of runs when the cursor was issued.
+    :param before: The sort key of the last run returned by the previous page, None for the first page.
+    """
+    headers = {
+        "Authorization": f"Bearer {token.token}",
+        "Content-Type": "application/json"
+    }
+
+    runs = []
+    drifted = False
+    has_more = True
+    next_offset = offset
+
+    # Runs started since the previous page shift the offsets, the ones that were already returned are skipped
+    # and the following pages are fetched until the page is full or there are no more runs
+    while has_more and len(runs) < limit:
+        url = f'{os.getenv("BASE_URL")}/api/pipeline_runs?_limit={limit}&_offset={next_offset}&pipeline_uuid={pipeline_name}&disable_retries_grouping=true&api_key={os.getenv("API_KEY")}'
+
+        response = await mage_client.request("GET", url, headers=headers)
+
+        if response.status_code != 200 or response.json().get("error") is not None:
+            raise HTTPException(detail=response.json().get("error")["exception"], status_code=500)
+
+        pipeline_runs = response.json()["pipeline_runs"]
+        has_more = len(pipeline_runs) == limit
+
+        page_offset = next_offset
+        next_offset += len(pipeline_runs)
+        for i, pipeline_run in enumerate(pipeline_runs):
+            if before is not None and history_sort_key(pipeline_run) >= before:
+                drifted = True
+                continue
+
+            runs.append(pipeline_run)
+            if len(runs) == limit:
+                # The rest of the page is returned with the next cursor
+                next_offset = page_offset + i + 1
+                has_more = has_more or i + 1 < len(pipeline_runs)
+                break
+
+    next_cursor = encode_history_cursor(next_offset, history_sort_key(runs[-1])) if has_more and len(runs) > 0 else None
+
+    return {
+        "runs": [parse_pipeline_run(pipeline_run) for pipeline_run in runs],
+        "next_cursor": next_cursor,
+        # A page read across shifted offsets is not cached, its cursor would keep the stale offset
+        "cacheable": not drifted and all(pipeline_run["status"] in FINISHED_RUN_STATUSES for pipeline_run in runs)
+    }
+
+
+def history_response(runs: list[dict], next_cursor: str | None) -> JSONResponse:
+    # The body stays a list of runs, the cursor of the next page is sent in a header
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor is not None else None
+
+    return JSONResponse(runs, status_code=200, headers=headers)
+
+
+def cancel_downloads(downloads: list[tuple[str, asyncio.Task]]) -> None:
+    for _, task in downloads:
+        task.cancel()
+        # Retrieves the error of the downloads that already failed, so it is not logged as never retrieved
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
@@ -1,25 +1,22 @@
 import os
 import json
-import httpx
 import random
 import string
-import requests
+import mage_client.client as mage_client
 from datetime import datetime
-from dependencies import Token
+from dependencies import token
 from fastapi import APIRouter, HTTPException, UploadFile
 from starlette.responses import JSONResponse
+from redis_cache.pipelines import invalidate_pipelines, invalidate_all_pipelines
+from mage_client.files import invalidate_file_tree
 from utils.models import Pipeline, Secret, Trigger, Variables, Tag
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.post("/mage/pipeline/create", tags=["PIPELINES POST"])
 async def pipeline_create(name: str, ptype: str):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if ptype not in ["python", "streaming"]:
@@ -41,19 +38,20 @@ async def pipeline_create(name: str, ptype: str):
         }
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = await mage_client.request("POST", url, headers=headers, content=json.dumps(data))
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    invalidate_pipelines(response.json().get("pipeline", {}).get("uuid", name))
+    invalidate_file_tree()
+
     return JSONResponse(status_code=201, content="Pipeline Created")
 
 
 @router.post("/mage/pipeline/create/tag", tags=["PIPELINES POST"])
 async def pipeline_create_tag(tag: Tag):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{tag.name}?update_content=true&api_key={os.getenv("API_KEY")}'
@@ -71,7 +69,7 @@ async def pipeline_create_tag(tag: Tag):
         }
     }
 
-    response = requests.request("PUT", url, data=json.dumps(body), headers=headers)
+    response = await mage_client.request("PUT", url, content=json.dumps(body), headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -81,9 +79,7 @@ async def pipeline_create_tag(tag: Tag):
 
 @router.post("/mage/pipeline/create/trigger", tags=["PIPELINES POST"])
 async def pipeline_create_trigger(trigger: Trigger):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     if trigger.trigger_type not in ["time", "api"]:
@@ -119,7 +115,7 @@ async def pipeline_create_trigger(trigger: Trigger):
             "api_key": os.getenv("API_KEY")
         })
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = await mage_client.request("POST", url, headers=headers, content=payload)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -129,9 +125,7 @@ async def pipeline_create_trigger(trigger: Trigger):
 
 @router.post("/mage/pipeline/run", tags=["PIPELINES POST"])
 async def run_pipeline(pipe: Pipeline):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f"{os.getenv('BASE_URL')}/api/pipeline_schedules/{pipe.run_id}/api_trigger"
@@ -151,7 +145,7 @@ async def run_pipeline(pipe: Pipeline):
     for k, v in pipe.variables.items():
         body['pipeline_run']['variables'][k] = v
 
-    response = requests.post(url, headers=headers, json=body)
+    response = await mage_client.request("POST", url, headers=headers, json=body)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -161,9 +155,7 @@ async def run_pipeline(pipe: Pipeline):
 
 @router.post("/mage/pipeline/variables", tags=["PIPELINES POST"])
 async def create_variables(variables: Variables):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
     
     if len(variables.variables.keys()) == 0:
@@ -191,7 +183,7 @@ async def create_variables(variables: Variables):
 
         payload = json.dumps(data, indent=4)
 
-        response = requests.request("POST", url, headers=headers, data=payload)
+        response = await mage_client.request("POST", url, headers=headers, content=payload)
 
         if response.status_code != 200:
             error_counter += 1
@@ -207,9 +199,7 @@ async def import_pipeline(file: UploadFile):
     if file.content_type != "application/zip":
         raise HTTPException(status_code=500, detail="Only zip files are allowed!")
     
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     headers = {
@@ -229,20 +219,20 @@ async def import_pipeline(file: UploadFile):
         ),
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, files=files)
+    response = await mage_client.request("POST", url, headers=headers, files=files)
 
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error encountered when importing the pipeline!")
 
+    invalidate_all_pipelines()
+    invalidate_file_tree()
+
     return JSONResponse(status_code=200, content="Pipeline imported sucessfully!")
 
 
 @router.post("/mage/pipeline/secret", tags=["PIPELINES POST"])
 async def create_secret(secret: Secret):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
     
     url = f'{os.getenv("BASE_URL")}/api/secrets?api_key={os.getenv("API_KEY")}'
@@ -261,7 +251,7 @@ async def create_secret(secret: Secret):
         "api_key": os.getenv("API_KEY")
     }
 
-    response = requests.request("POST", url, headers=headers, json=body)
+    response = await mage_client.request("POST", url, headers=headers, json=body)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
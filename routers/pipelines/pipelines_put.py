@@ -1,22 +1,20 @@
 import os
 import json
-import requests
-from dependencies import Token
+import mage_client.client as mage_client
+from dependencies import token
 from fastapi import APIRouter, HTTPException
 from starlette.responses import JSONResponse
+from redis_cache.pipelines import invalidate_pipelines
+from mage_client.files import invalidate_file_tree
 from utils.models import Status, Description, UpdateTrigger, Rename
 
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.put("/mage/pipeline/rename", tags=["PIPELINES PUT"])
 async def rename_pipeline(rename: Rename):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{rename.current_name}?api_key={os.getenv("API_KEY")}'
@@ -33,19 +31,20 @@ async def rename_pipeline(rename: Rename):
         "Authorization": f"Bearer {token.token}"
     }
 
-    response = requests.request("PUT", url, headers=headers, json=data)
+    response = await mage_client.request("PUT", url, headers=headers, json=data)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
+    invalidate_pipelines(rename.current_name, response.json().get("pipeline", {}).get("uuid", rename.new_name))
+    invalidate_file_tree()
+
     return JSONResponse(status_code=200, content="Pipeline renamed successfully!")
 
 
 @router.put("/mage/pipeline/trigger/status", tags=["PIPELINES PUT"])
 async def pipeline_enable_trigger(status: Status):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
     
     if status.status not in ["active", "inactive"]:
@@ -65,7 +64,7 @@ async def pipeline_enable_trigger(status: Status):
         "api_key": os.getenv("API_KEY")
     })
 
-    response = requests.request("PUT", url, headers=headers, data=payload)
+    response = await mage_client.request("PUT", url, headers=headers, content=payload)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -75,9 +74,7 @@ async def pipeline_enable_trigger(status: Status):
 
 @router.put("/mage/pipeline/trigger/update", tags=["PIPELINES PUT"])
 async def trigger_update(trigger: UpdateTrigger):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         raise HTTPException(status_code=500, detail="Could not get the token!")
     
     if trigger.status not in ["start", "stop"]:
@@ -90,7 +87,7 @@ async def trigger_update(trigger: UpdateTrigger):
 
     runs_url = f"{os.getenv('BASE_URL')}/api/pipeline_runs?pipeline_uuid={trigger.pipeline_uuid}&api_key={os.getenv('API_KEY')}"
         
-    runs_response = requests.request("GET", runs_url, headers=headers)
+    runs_response = await mage_client.request("GET", runs_url, headers=headers)
 
     if runs_response.status_code != 200 or runs_response.json().get("error") is not None:
         raise HTTPException(status_code=500, detail=runs_response.json().get("error")["exception"])
@@ -115,7 +112,7 @@ async def trigger_update(trigger: UpdateTrigger):
 
         url = f"{os.getenv('BASE_URL')}/api/pipeline_schedules/{trigger.trigger_id}?api_key={os.getenv('API_KEY')}"
 
-        response = requests.request("PUT", url, headers=headers, data=json.dumps(body, indent=4))
+        response = await mage_client.request("PUT", url, headers=headers, content=json.dumps(body, indent=4))
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -130,14 +127,14 @@ async def trigger_update(trigger: UpdateTrigger):
 
         url = f"{os.getenv('BASE_URL')}/api/pipeline_schedules/{trigger.trigger_id}?api_key={os.getenv('API_KEY')}"
 
-        response = requests.request("PUT", url, headers=headers, data=json.dumps(body, indent=4))
+        response = await mage_client.request("PUT", url, headers=headers, content=json.dumps(body, indent=4))
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
 
         url = f"{os.getenv('BASE_URL')}/api/pipeline_runs/{last_run_id}?api_key={os.getenv('API_KEY')}"
 
-        response = requests.request("DELETE", url, headers=headers)
+        response = await mage_client.request("DELETE", url, headers=headers)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             raise HTTPException(status_code=500, detail=response.json().get("error")["exception"])
@@ -147,9 +144,7 @@ async def trigger_update(trigger: UpdateTrigger):
 
 @router.put("/mage/pipeline/description", tags=["PIPELINES PUT"])
 async def put_description(desc: Description):
-    if token.check_token_expired():
-        token.update_token()
-    if token.token == "":
+    if await token.get_token() == "":
         return JSONResponse(status_code=500, content="Could not get the token!")
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{desc.name}'
@@ -168,9 +163,11 @@ async def put_description(desc: Description):
 
     payload = json.dumps(data, indent=4)
 
-    response = requests.request("PUT", url, headers=headers, data=payload)
+    response = await mage_client.request("PUT", url, headers=headers, content=payload)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return JSONResponse(status_code=500, content=response.json().get("error")["exception"])
 
+    invalidate_pipelines(desc.name)
+
     return JSONResponse(status_code=200, content="Pipeline updated successfully!")
@@ -2,22 +2,18 @@ from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 import routers.validate.validate_utils as validate_utils
 from pydantic import ValidationError
 from utils.models import Validate
-from dependencies import Token
-import time
+from dependencies import token
+import asyncio
 
 router = APIRouter()
 
-token = Token()
-
 
 @router.websocket("/mage/validate")
 async def validate(websocket: WebSocket):
     await websocket.accept()
 
     try:
-        if token.check_token_expired():
-            token.update_token()
-        if token.token == "":
+        if await token.get_token() == "":
             await websocket.send_json({"detail": "Failed to retrieve authentication token."})
             await websocket.close()
             return
@@ -27,7 +23,7 @@ async def validate(websocket: WebSocket):
         validated_data = Validate(**data)
 
         # Step 1: Create the pipeline
-        pipeline_name = validate_utils.create_temp_pipeline(token.token)
+        pipeline_name = await validate_utils.create_temp_pipeline(token.token)
         if not pipeline_name:
             await websocket.send_json({"detail": "Failed to create pipeline."})
             await websocket.close()
@@ -35,8 +31,8 @@ async def validate(websocket: WebSocket):
         await websocket.send_json({"message": f"Pipeline created: {pipeline_name}"})
 
         # Step 2: Create a trigger for the pipeline
-        if not validate_utils.create_temp_pipeline_trigger(pipeline_name, token.token):
-            validate_utils.delete_temp_pipeline(pipeline_name, token.token)
+        if not await validate_utils.create_temp_pipeline_trigger(pipeline_name, token.token):
+            await validate_utils.delete_temp_pipeline(pipeline_name, token.token)
             await websocket.send_json({"detail": "Failed to create pipeline trigger."})
             await websocket.close()
             return
@@ -45,16 +41,16 @@ async def validate(websocket: WebSocket):
         # Step 3: Create the blocks inside the pipeline
         # Assuming you have some predefined blocks to create
 
-        if not validate_utils.create_block(pipeline_name, token.token, validated_data.block_type, validated_data.content):
-            validate_utils.delete_temp_pipeline(pipeline_name, token.token)
+        if not await validate_utils.create_block(pipeline_name, token.token, validated_data.block_type, validated_data.content):
+            await validate_utils.delete_temp_pipeline(pipeline_name, token.token)
             await websocket.send_json({"detail": "Failed to create blocks."})
             await websocket.close()
             return
         await websocket.send_json({"message": "Blocks created."})
 
         # Step 4: Run the pipeline
-        if not validate_utils.run_temp_pipeline(pipeline_name, token.token):
-            validate_utils.delete_temp_pipeline(pipeline_name, token.token)
+        if not await validate_utils.run_temp_pipeline(pipeline_name, token.token):
+            await validate_utils.delete_temp_pipeline(pipeline_name, token.token)
             await websocket.send_json({"detail": "Failed to run the pipeline."})
             await websocket.close()
             return
@@ -66,7 +62,7 @@ async def validate(websocket: WebSocket):
             if counter > 100:
                 break
 
-            status = validate_utils.check_temp_pipeline_status(pipeline_name, token.token)
+            status = await validate_utils.check_temp_pipeline_status(pipeline_name, token.token)
             if status in ["completed", "failed"]:
                 if status == "completed":
                     await websocket.send_json({"success": "passed"})
@@ -75,10 +71,10 @@ async def validate(websocket: WebSocket):
                 break
             await websocket.send_json({"message": f"Pipeline status: {status}"})
             counter += 1
-            time.sleep(5)  # Poll every 5 seconds
+            await asyncio.sleep(5)  # Poll every 5 seconds
 
         # Step 6: Delete the pipeline
-        if not validate_utils.delete_temp_pipeline(pipeline_name, token.token):
+        if not await validate_utils.delete_temp_pipeline(pipeline_name, token.token):
             await websocket.send_json({"detail": "Failed to delete the pipeline."})
             await websocket.close()
             return
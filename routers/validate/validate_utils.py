@@ -1,10 +1,10 @@
 import os
 import json
-import requests
+import mage_client.client as mage_client
 import randomname
 
 
-def create_temp_pipeline(token: str) -> str:
+async def create_temp_pipeline(token: str) -> str:
     url = f'{os.getenv("BASE_URL")}/api/pipelines'
 
     headers = {
@@ -23,7 +23,7 @@ def create_temp_pipeline(token: str) -> str:
         }
     }
 
-    response = requests.request("POST", url, headers=headers, data=json.dumps(data))
+    response = await mage_client.request("POST", url, headers=headers, content=json.dumps(data))
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return ""
@@ -31,7 +31,7 @@ def create_temp_pipeline(token: str) -> str:
     return name
 
 
-def create_temp_pipeline_trigger(name: str, token: str) -> bool:
+async def create_temp_pipeline_trigger(name: str, token: str) -> bool:
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}/pipeline_schedules?api_key={os.getenv("API_KEY")}'
     headers = {
         "Authorization": f"Bearer {token}",
@@ -47,7 +47,7 @@ def create_temp_pipeline_trigger(name: str, token: str) -> bool:
         "api_key": os.getenv("API_KEY")
     })
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = await mage_client.request("POST", url, headers=headers, content=payload)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return False
@@ -55,14 +55,14 @@ def create_temp_pipeline_trigger(name: str, token: str) -> bool:
     return True
 
 
-def run_temp_pipeline(name: str, token: str) -> bool:
+async def run_temp_pipeline(name: str, token: str) -> bool:
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}/pipeline_schedules?api_key={os.getenv("API_KEY")}'
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return False
@@ -79,7 +79,7 @@ def run_temp_pipeline(name: str, token: str) -> bool:
         "Authorization": f"Bearer {trigger_config['token']}"
     }
 
-    response = requests.request("POST", url, headers=headers)
+    response = await mage_client.request("POST", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return False
@@ -87,7 +87,7 @@ def run_temp_pipeline(name: str, token: str) -> bool:
     return True
 
 
-def create_block(name: str, token: str, btype: str, content: str) -> bool:
+async def create_block(name: str, token: str, btype: str, content: str) -> bool:
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json, text/plain, */*",
@@ -124,8 +124,8 @@ def load_data(*args, **kwargs):
             "api-key": os.getenv("API_KEY")
         }
 
-        response = requests.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{name}/blocks?'
-                                                f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
+        response = await mage_client.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{name}/blocks?'
+                                             f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             return False
@@ -142,8 +142,8 @@ def load_data(*args, **kwargs):
             "api-key": os.getenv("API_KEY")
         }
 
-        response = requests.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{name}/blocks?'
-                                                f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
+        response = await mage_client.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{name}/blocks?'
+                                             f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             return False
@@ -160,8 +160,8 @@ def load_data(*args, **kwargs):
             "api-key": os.getenv("API_KEY")
         }
 
-        response = requests.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{name}/blocks?'
-                                                f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
+        response = await mage_client.request("POST", url=f'{os.getenv("BASE_URL")}/api/pipelines/{name}/blocks?'
+                                             f'api_key={os.getenv("API_KEY")}', headers=headers, json=payload)
 
         if response.status_code != 200 or response.json().get("error") is not None:
             return False
@@ -169,14 +169,14 @@ def load_data(*args, **kwargs):
     return True
 
 
-def check_temp_pipeline_status(name: str, token: str) -> str:
+async def check_temp_pipeline_status(name: str, token: str) -> str:
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}/pipeline_schedules?api_key={os.getenv("API_KEY")}'
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return ""
@@ -189,7 +189,7 @@ def check_temp_pipeline_status(name: str, token: str) -> str:
         'Authorization': f'Bearer {token}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return ""
@@ -202,14 +202,14 @@ def check_temp_pipeline_status(name: str, token: str) -> str:
     return body[0]["status"]
 
 
-def delete_temp_pipeline(name: str, token: str) -> bool:
+async def delete_temp_pipeline(name: str, token: str) -> bool:
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}/pipeline_schedules?api_key={os.getenv("API_KEY")}'
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = await mage_client.request("GET", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return False
@@ -222,7 +222,7 @@ def delete_temp_pipeline(name: str, token: str) -> bool:
 
     pipeline_schedule = response.json()["pipeline_schedules"][0]
 
-    response = requests.request(
+    response = await mage_client.request(
             "DELETE",
             f'{os.getenv("BASE_URL")}/api/pipeline_schedules/{pipeline_schedule["id"]}?api_key={os.getenv("API_KEY")}',
             headers=headers
@@ -233,7 +233,7 @@ def delete_temp_pipeline(name: str, token: str) -> bool:
 
     url = f'{os.getenv("BASE_URL")}/api/pipelines/{name}'
 
-    response = requests.request("DELETE", url, headers=headers)
+    response = await mage_client.request("DELETE", url, headers=headers)
 
     if response.status_code != 200 or response.json().get("error") is not None:
         return False
@@ -0,0 +1,36 @@
+import os
+import uvicorn
+
+# Entry point of the API. It is kept apart from main.py because the CWL conversion workers are spawned and
+# re-import the entry module, importing main.py there would start the whole API, RAG included, in every worker
+
+if __name__ == '__main__':
+    # If .env exists locally, use that for environment variables
+    # In a docker image is built ignoring the .env so it can't appear in a container
+    if os.path.exists(".env"):
+        from dotenv import load_dotenv
+        load_dotenv(".env")
+
+    if os.getenv('AUTH') is None:
+        print("AUTH env variable is required can be [true, false]")
+        exit(1)
+    else:
+        if os.getenv('AUTH') == 'true':
+            if os.getenv('EMAIL') is None or os.getenv('PASSWORD') is None:
+                print("EMAIL or PASSWORD env variable not provided. If AUTH is true they are required!")
+                exit(1)
+
+    if os.getenv('BASE_URL') is None:
+        print("BASE_URL env variable is required!")
+        exit(1)
+
+    if os.getenv('OLLAMA_URL') is None:
+        print("OLLAMA_URL env variable is required!")
+        exit(1)
+
+    os.environ["API_KEY"] = "zkWlN0PkIKSN0C11CfUHUj84OT5XOJ6tDZ6bDRO2"
+
+    # The app is imported only here, the worker processes that re-import this module as __mp_main__ skip it
+    from main import app
+
+    uvicorn.run(app, host="0.0.0.0", ws_ping_timeout=1000.0)
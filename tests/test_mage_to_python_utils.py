@@ -0,0 +1,75 @@
+import ast
+import sys
+import pickle
+from mage_to_cwl.mage_to_python_utils import remove_unused_code, remove_imports_with_word
+
+
+def test_keeps_methods_of_used_classes():
+    code = """
+class Scaler:
+    def __init__(self, factor):
+        self.factor = factor
+
+    def fit(self, values):
+        return self
+
+    def transform(self, values):
+        return [value * self.factor for value in values]
+
+
+def unused():
+    pass
+
+
+print(Scaler(2).fit([1]).transform([1]))
+"""
+    tree = ast.parse(remove_unused_code(code))
+
+    functions = {node.name for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)}
+    assert functions == {"__init__", "fit", "transform"}
+
+
+def test_removes_unused_classes_with_their_methods():
+    code = """
+class Unused:
+    def method(self):
+        pass
+
+
+print(1)
+"""
+    tree = ast.parse(remove_unused_code(code))
+
+    assert not any(isinstance(node, (ast.ClassDef, ast.FunctionDef)) for node in ast.walk(tree))
+
+
+def test_fan_in_loads_every_upstream_output(tmp_path, monkeypatch):
+    code = """
+from mage_ai.data_preparation.decorators import transformer
+
+
+@transformer
+def transform(data, *args, **kwargs):
+    return data + sum(args)
+"""
+    converted, env_vars = remove_imports_with_word(code, "mage_ai", "join", ["left", "middle", "right"])
+    assert env_vars == ["JOIN_OUTPUT_FILE"]
+
+    # The generated script is run as is, without the pandas import added for DataFrame blocks
+    tree = ast.parse(converted)
+    tree.body = [node for node in tree.body
+                 if not (isinstance(node, ast.Import) and any(alias.name == "pandas" for alias in node.names))]
+
+    filenames = []
+    for name, value in [("left", 1), ("middle", 2), ("right", 3)]:
+        filenames.append(str(tmp_path / f"{name}_result"))
+        with open(filenames[-1], "wb") as file:
+            pickle.dump(value, file)
+
+    output_file = tmp_path / "join_result"
+    monkeypatch.setenv("JOIN_OUTPUT_FILE", str(output_file))
+    monkeypatch.setattr(sys, "argv", ["join.py", *filenames])
+    exec(compile(tree, "join.py", "exec"), {"__name__": "__main__"})
+
+    with open(output_file, "rb") as file:
+        assert pickle.load(file) == 6
@@ -0,0 +1,33 @@
+import json
+import hashlib
+from typing import Any
+from fastapi import Request
+from starlette.responses import JSONResponse, Response
+
+
+def compute_etag(content: Any) -> str:
+    digest = hashlib.sha1(json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+    return f'"{digest}"'
+
+
+def combine_etags(etags: list[str]) -> str:
+    return f'"{hashlib.sha1(",".join(etags).encode("utf-8")).hexdigest()}"'
+
+
+def etag_response(request: Request, content: Any, etag: str | None = None) -> Response:
+    """
+    Answers with 304 Not Modified when the If-None-Match header of the request matches the ETag of the content.
+    :param request: The incoming request.
+    :param content: The JSON serializable content of the response.
+    :param etag: The ETag of the content if it is already known, for example stored with a cache entry.
+    """
+    if etag is None:
+        etag = compute_etag(content)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers={"ETag": etag})
+
+    return JSONResponse(status_code=200, content=content, headers={"ETag": etag})
@@ -0,0 +1,95 @@
+import json
+from typing import Any, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+START_MARKER = "Start executing block with BlockExecutor."
+END_MARKER = "-----"
+
+# Every log line starts with a timestamp of this length, followed by the JSON of the entry
+PREFIX_LENGTH = 20
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+def parse_line(line: str) -> dict[str, Any] | None:
+    try:
+        return _loads(line[PREFIX_LENGTH:])
+    except ValueError:
+        return None
+
+
+def parse_lines(content: str, start: int = 0, end: int | None = None) -> list[dict[str, Any]]:
+    """
+    Decodes the lines of content between the start and end offsets, the lines that are not JSON are skipped.
+    """
+    entries = []
+    for line in content[start:end].split("\n"):
+        entry = parse_line(line)
+        if entry is not None:
+            entries.append(entry)
+
+    return entries
+
+
+def find_marker_line(content: str, marker: str, start: int = 0, exact: bool = False) -> tuple[int, int] | None:
+    """
+    Finds the first line at or after start whose message contains marker, without decoding the lines before it.
+    Returns the offsets of the beginning and of the end of the line.
+    :param content: The log content.
+    :param marker: The text the message has to contain.
+    :param start: Offset where the search begins.
+    :param exact: The message has to be equal to marker instead of containing it.
+    """
+    position = content.find(marker, start)
+    while position != -1:
+        line_start = max(content.rfind("\n", 0, position) + 1, start)
+        line_end = content.find("\n", position)
+        if line_end == -1:
+            line_end = len(content)
+
+        # The marker may also appear in another field or inside a longer message
+        entry = parse_line(content[line_start:line_end])
+        if entry is not None and isinstance(entry.get("message"), str):
+            if entry["message"] == marker or (not exact and marker in entry["message"]):
+                return line_start, line_end
+
+        position = content.find(marker, line_end)
+
+    return None
+
+
+def last_line(content: str) -> str:
+    """
+    Returns the last complete line of content, the same as content.split("\\n")[-2] without splitting the whole log.
+    """
+    end = content.rfind("\n")
+    return content[content.rfind("\n", 0, end) + 1:end] if end != -1 else ""
+
+
+def format_entry(entry: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "Log Level": entry["level"],
+        "Timestamp": entry["timestamp"],
+        "Message": entry["message"],
+    }
+
+
+def find_lines(content: str, needle: str) -> Iterator[str]:
+    """
+    Yields the lines of content that contain needle, the other lines are skipped without being split or decoded.
+    :param content: The log content.
+    :param needle: The text the line has to contain.
+    """
+    position = content.find(needle)
+    while position != -1:
+        line_start = content.rfind("\n", 0, position) + 1
+        line_end = content.find("\n", position)
+        if line_end == -1:
+            line_end = len(content)
+
+        yield content[line_start:line_end]
+        position = content.find(needle, line_end)
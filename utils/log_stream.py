@@ -0,0 +1,139 @@
+import os
+import asyncio
+from typing import Any, Awaitable, Callable
+from utils.log_tail import get_block_log_tail
+
+# How often the logs of a pipeline with subscribers are downloaded from Mage
+LOG_STREAM_INTERVAL = float(os.getenv("LOG_STREAM_INTERVAL", "2"))
+
+# Events waiting to be sent to a subscriber, a slower subscriber gets the whole log again instead
+LOG_STREAM_QUEUE_SIZE = int(os.getenv("LOG_STREAM_QUEUE_SIZE", "100"))
+
+# After this many polls in a row fail the subscribers are sent an error and the poller stops
+LOG_STREAM_MAX_FAILURES = int(os.getenv("LOG_STREAM_MAX_FAILURES", "5"))
+
+
+class _Subscriber:
+    def __init__(self, file: str | None, offset: int) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=LOG_STREAM_QUEUE_SIZE)
+        self.file = file
+        self.offset = offset
+
+
+class PipelineLogPoller:
+    def __init__(self, pipeline_name: str, fetch_logs: Callable[[str], Awaitable[dict[str, dict]]]) -> None:
+        """
+        Downloads the logs of a pipeline once per interval and fans the new lines out to every subscriber,
+        so the number of requests to Mage does not grow with the number of clients watching the pipeline.
+        :param pipeline_name: The name of the pipeline.
+        :param fetch_logs: Coroutine function returning the latest log of every block of the pipeline, by block name.
+        """
+        self.pipeline_name = pipeline_name
+        self.fetch_logs = fetch_logs
+        self._subscribers: dict[str, list[_Subscriber]] = {}
+        self._task: asyncio.Task | None = None
+
+    def subscribe(self, block_name: str, file: str | None = None, offset: int = 0) -> _Subscriber:
+        subscriber = _Subscriber(file, offset)
+        self._subscribers.setdefault(block_name, []).append(subscriber)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        return subscriber
+
+    def unsubscribe(self, block_name: str, subscriber: _Subscriber) -> None:
+        subscribers = self._subscribers.get(block_name, [])
+        if subscriber in subscribers:
+            subscribers.remove(subscriber)
+        if len(subscribers) == 0:
+            self._subscribers.pop(block_name, None)
+
+        if len(self._subscribers) == 0:
+            self.stop()
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        # A poller that stopped on its own may already have been replaced by a new one for the same pipeline
+        if _pollers.get(self.pipeline_name) is self:
+            del _pollers[self.pipeline_name]
+
+    def _fail(self, error: str) -> None:
+        self._task = None
+        self.stop()
+
+        for subscribers in self._subscribers.values():
+            for subscriber in subscribers:
+                # The error is sent even to a subscriber that did not keep up, its pending events are dropped
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait({"error": error})
+
+    def _publish(self, block_name: str, log: dict) -> None:
+        tail = get_block_log_tail(self.pipeline_name, block_name, log)
+
+        for subscriber in self._subscribers.get(block_name, []):
+            reset = (subscriber.file is not None and subscriber.file != tail.file) or subscriber.offset > len(tail.entries)
+            offset = 0 if reset else subscriber.offset
+            if not reset and offset == len(tail.entries):
+                continue
+
+            event = {
+                "cursor": {
+                    "file": tail.file,
+                    "modified_timestamp": tail.modified_timestamp,
+                    "offset": len(tail.entries)
+                },
+                "reset": reset,
+                "lines": tail.entries[offset:]
+            }
+
+            if subscriber.queue.full():
+                # The subscriber did not keep up, its pending events are replaced by the whole log
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                event["reset"] = True
+                event["lines"] = tail.entries
+
+            subscriber.queue.put_nowait(event)
+            subscriber.file = tail.file
+            subscriber.offset = len(tail.entries)
+
+    async def _run(self) -> None:
+        failures = 0
+        while True:
+            try:
+                logs = await self.fetch_logs(self.pipeline_name)
+                for block_name in list(self._subscribers.keys()):
+                    if block_name in logs:
+                        self._publish(block_name, logs[block_name])
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to poll the logs of {self.pipeline_name}: {e}")
+
+                failures += 1
+                if failures >= LOG_STREAM_MAX_FAILURES:
+                    self._fail(getattr(e, "detail", None) or str(e))
+                    return
+
+            await asyncio.sleep(LOG_STREAM_INTERVAL)
+
+
+_pollers: dict[str, PipelineLogPoller] = {}
+
+
+def get_poller(pipeline_name: str, fetch_logs: Callable[[str], Awaitable[dict[str, Any]]]) -> PipelineLogPoller:
+    if pipeline_name not in _pollers:
+        _pollers[pipeline_name] = PipelineLogPoller(pipeline_name, fetch_logs)
+
+    return _pollers[pipeline_name]
+
+
+def stop_pollers() -> None:
+    for poller in list(_pollers.values()):
+        poller.stop()
@@ -0,0 +1,92 @@
+import os
+from redis_cache.local_cache import LocalCache
+from utils.log_parser import START_MARKER, END_MARKER, parse_line, parse_lines, find_marker_line, format_entry
+
+
+class BlockLogTail:
+    def __init__(self, file: str) -> None:
+        """
+        Parsed lines of a block log, the content appended to the log is parsed only once.
+        Keeps the lines between the start of the block execution and the end marker, like the block logs endpoint.
+        :param file: The path of the log file in Mage.
+        """
+        self.file = file
+        self.modified_timestamp = None
+        self.size = 0
+        self.entries: list[dict] = []
+        self._started = False
+        self._finished = False
+        self._partial = ""
+
+    def _reset(self) -> None:
+        self.size = 0
+        self.entries = []
+        self._started = False
+        self._finished = False
+        self._partial = ""
+
+    def _consume(self, text: str) -> None:
+        # Only the lines inside the block execution are decoded, the markers are found with a plain text search
+        if self._finished or text == "":
+            return
+
+        start = 0
+        if not self._started:
+            marker = find_marker_line(text, START_MARKER, exact=True)
+            if marker is None:
+                return
+            self._started = True
+            start = marker[1]
+
+        marker = find_marker_line(text, END_MARKER, start)
+        self.entries.extend(format_entry(entry) for entry in parse_lines(text, start, marker[0] if marker else None))
+        self._finished = marker is not None
+
+    def update(self, content: str, modified_timestamp) -> None:
+        """
+        Parses the part of content that was appended since the last update.
+        :param content: The whole content of the log file.
+        :param modified_timestamp: When the log file was last modified, nothing is parsed if it did not change.
+        """
+        if modified_timestamp == self.modified_timestamp and len(content) == self.size:
+            return
+
+        # Logs are only appended to, a shorter log means the file was replaced
+        if len(content) < self.size:
+            self._reset()
+
+        text = self._partial + content[self.size:]
+        self.size = len(content)
+        self.modified_timestamp = modified_timestamp
+
+        # The last line may still be written, it is kept until it is complete
+        cut = text.rfind("\n") + 1
+        complete, self._partial = text[:cut], text[cut:]
+        if self._partial and parse_line(self._partial) is not None:
+            complete, self._partial = text, ""
+
+        self._consume(complete)
+
+
+_tails = LocalCache(max_entries=int(os.getenv("LOG_TAIL_CACHE_SIZE", "128")),
+                    ttl_seconds=float(os.getenv("LOG_TAIL_CACHE_TTL", "600")))
+
+
+def get_block_log_tail(pipeline_name: str, block_name: str, log: dict) -> BlockLogTail:
+    """
+    Returns the parsed lines of the latest log of a block, parsing only what was appended since the last call.
+    :param pipeline_name: The name of the pipeline.
+    :param block_name: The name of the block.
+    :param log: The latest log of the block, as returned by Mage.
+    """
+    key = f"{pipeline_name}:{block_name}"
+    file = log.get("path", log["name"])
+
+    tail = _tails.get(key)
+    if tail is None or tail.file != file:
+        tail = BlockLogTail(file)
+
+    tail.update(log["content"], log["modified_timestamp"])
+    _tails.set(key, tail)
+
+    return tail
@@ -44,3 +44,27 @@ def parse_pipeline(pipeline: Dict[str, Any]):
         "blocks": blocks
     }
     return parsed_pipeline
+
+
+def parse_pipeline_run(pipeline_run: Dict[str, Any]):
+    block_runs = pipeline_run["block_runs"]
+    failed_index = next((i for i, block_run in enumerate(block_runs) if block_run["status"] == "failed"), None)
+
+    # The execution date looks like 2024-01-31 12:30:45.123456, only the minutes are kept
+    parsed_pipeline_run = {
+        "status": pipeline_run["status"],
+        "variables": pipeline_run["variables"],
+        "running_date": pipeline_run["execution_date"][:16],
+        "last_completed_block": block_runs[-1]["block_uuid"] if len(block_runs) > 0 else "-",
+        "last_failed_block": "-",
+        "error_message": "-"
+    }
+
+    if failed_index is not None:
+        failed_block_run = block_runs[failed_index]
+        parsed_pipeline_run["last_completed_block"] = block_runs[failed_index - 1]["block_uuid"]
+        parsed_pipeline_run["last_failed_block"] = failed_block_run["block_uuid"]
+        parsed_pipeline_run["error_message"] = failed_block_run["metrics"]["error"]["error"] if len(
+            failed_block_run["metrics"].keys()) else "-"
+
+    return parsed_pipeline_run
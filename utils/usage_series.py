@@ -0,0 +1,92 @@
+from array import array
+from datetime import datetime
+from utils.log_parser import PREFIX_LENGTH, find_lines, parse_line
+
+USAGE_LABELS = {
+    'cpu': 'CPU Utilization (%)',
+    'cpu_total': 'Total CPU Cores',
+    'cpu_usage': 'CPU Usage Ratio (%)',
+    'memory': 'Memory Used (MB)',
+    'memory_total': 'Total Memory (MB)',
+    'memory_usage': 'Memory Usage Ratio (%)'
+}
+
+# Ratios that are reported as percentages
+PERCENTAGES = ("cpu", "cpu_usage", "memory_usage")
+
+# Every usage sample of the scheduler has this key, the other lines of the log are not decoded
+USAGE_NEEDLE = '"memory_usage"'
+
+
+def _sample_time(line: str, entry: dict) -> float | None:
+    if isinstance(entry.get("timestamp"), (int, float)):
+        return float(entry["timestamp"])
+
+    try:
+        return datetime.fromisoformat(line[:PREFIX_LENGTH].strip()).timestamp()
+    except ValueError:
+        return None
+
+
+class UsageSeries:
+    def __init__(self) -> None:
+        """
+        Resource usage samples of a pipeline run, stored as one array of doubles per metric.
+        """
+        self.timestamps = array("d")
+        self.columns = {key: array("d") for key in USAGE_LABELS}
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def append(self, timestamp: float, sample: dict) -> None:
+        self.timestamps.append(timestamp)
+        for key, column in self.columns.items():
+            value = float(sample.get(key) or 0.0)
+            column.append(value * 100 if key in PERCENTAGES else value)
+
+    def downsample(self, points: int) -> "UsageSeries":
+        """
+        Averages the samples into at most points buckets of consecutive samples.
+        :param points: The maximum number of samples to keep, 0 or less keeps all of them.
+        """
+        if points <= 0 or len(self) <= points:
+            return self
+
+        result = UsageSeries()
+        total = len(self)
+        for i in range(points):
+            start, end = i * total // points, (i + 1) * total // points
+            result.timestamps.append(sum(self.timestamps[start:end]) / (end - start))
+            for key, column in self.columns.items():
+                result.columns[key].append(sum(column[start:end]) / (end - start))
+
+        return result
+
+    def to_dict(self) -> dict[str, list[float]]:
+        return {"timestamps": self.timestamps.tolist(), **{key: column.tolist() for key, column in self.columns.items()}}
+
+    @classmethod
+    def from_dict(cls, content: dict[str, list[float]]) -> "UsageSeries":
+        series = cls()
+        series.timestamps = array("d", content["timestamps"])
+        series.columns = {key: array("d", content.get(key, [])) for key in USAGE_LABELS}
+        return series
+
+
+def parse_usage_series(content: str) -> UsageSeries:
+    """
+    Parses every resource usage sample of a scheduler log, in the order they were written.
+    :param content: The content of the scheduler log.
+    """
+    series = UsageSeries()
+    for line in find_lines(content, USAGE_NEEDLE):
+        entry = parse_line(line)
+        if not isinstance(entry, dict):
+            continue
+
+        timestamp = _sample_time(line, entry)
+        if timestamp is not None:
+            series.append(timestamp, entry)
+
+    return series
@@ -0,0 +1,42 @@
+import zipfile
+from typing import AsyncIterator
+
+
+class _ZipBuffer:
+    """
+    Write-only buffer without seek or tell, so zipfile writes every entry once followed by a data descriptor
+    instead of going back to patch its header.
+    """
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream_zip(entries: AsyncIterator[tuple[str, bytes | str]]) -> AsyncIterator[bytes]:
+    """
+    Builds a zip archive from entries and yields it chunk by chunk, as soon as each entry is compressed.
+    :param entries: Async iterator of the path inside the archive and the content of every file.
+    """
+    buffer = _ZipBuffer()
+
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+        async for path, content in entries:
+            zipf.writestr(path, content)
+
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+
+    # The central directory is written when the archive is closed
+    yield buffer.drain()